@@ -5,8 +5,21 @@ import py7zr
 import tempfile
 import xml.etree.ElementTree as ET
 import json
+import re
+import hashlib
+import unicodedata
+import sqlite3
 from pathlib import Path
 import time
+import random
+import threading
+import shutil
+import uuid
+from collections import deque, OrderedDict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import traceback
+import httpx
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -16,58 +29,284 @@ import warnings
 warnings.filterwarnings('ignore')
 
 from google import genai
-from google.genai import types
+from google.genai import types, errors
 
 # ===========================================================
 # CONFIGURAÇÃO DO CLIENTE GEMINI
 # ===========================================================
+# GEMINI_BASE_URL permite apontar para um servidor local (ex.: simulador de 429/lentidão)
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+
 client = None
 try:
-    client = genai.Client()
+    client = genai.Client(
+        http_options=types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+    )
     print("Cliente Gemini inicializado com sucesso.")
 except Exception as e:
     print(f"Erro ao inicializar cliente Gemini: {e}")
     print("Verifique se a variável de ambiente GEMINI_API_KEY está configurada corretamente.")
 
 # ===========================================================
-# ESTADO GLOBAL
+# GATEWAY LLM: LIMITE DE TAXA, RETRY E CONCORRÊNCIA
 # ===========================================================
-class AppState:
-    def __init__(self):
-        self.df = None
-        self.analysis_results = {}
-        self.csv_path = None
-        self.summary_stats = None
-        self.plots = {}
+# Configuração via variáveis de ambiente (compartilhada por todo o processo)
+LLM_RPM = int(os.environ.get("IGUACU_LLM_RPM", "15"))
+LLM_TPM = int(os.environ.get("IGUACU_LLM_TPM", "1000000"))
+LLM_MAX_CONCORRENCIA = int(os.environ.get("IGUACU_LLM_MAX_CONCORRENCIA", "4"))
+LLM_MAX_TENTATIVAS = int(os.environ.get("IGUACU_LLM_MAX_TENTATIVAS", "4"))
+LLM_PRAZO_S = float(os.environ.get("IGUACU_LLM_PRAZO_S", "120"))
+# Orçamento de latência da análise (a partir do início do job): sem resposta do LLM, relatório local
+ANALISE_SLA_S = float(os.environ.get("IGUACU_ANALISE_SLA_S", "60"))
+LLM_BACKOFF_BASE_S = 1.0
+LLM_BACKOFF_MAX_S = 30.0
+LLM_CHARS_POR_TOKEN = 4
+LLM_CODIGOS_REPETIVEIS = (408, 429, 500, 502, 503, 504)
+# Tempo mínimo para valer uma tentativa (HttpOptions(timeout=0) significaria "sem timeout")
+LLM_TENTATIVA_MIN_MS = 1000
+
+class LLMIndisponivelError(Exception):
+    """A chamada ao LLM não foi concluída dentro do prazo ou do número de tentativas"""
+
+class TokenBucket:
+    """Balde de fichas reposto continuamente à taxa de `por_minuto` fichas por minuto"""
+    def __init__(self, por_minuto):
+        self.capacidade = float(por_minuto)
+        self.fichas = float(por_minuto)
+        self.taxa = por_minuto / 60.0
+        self.ultimo = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _repor(self):
+        agora = time.monotonic()
+        self.fichas = min(self.capacidade, self.fichas + (agora - self.ultimo) * self.taxa)
+        self.ultimo = agora
+
+    def consumir(self, quantidade, prazo):
+        """Aguarda até haver `quantidade` fichas; False se isso ultrapassar o prazo (monotonic)"""
+        quantidade = min(quantidade, self.capacidade)
+        while True:
+            with self.lock:
+                self._repor()
+                if self.fichas >= quantidade:
+                    self.fichas -= quantidade
+                    return True
+                espera = (quantidade - self.fichas) / self.taxa
+            if time.monotonic() + espera > prazo:
+                return False
+            time.sleep(espera)
+
+    def ajustar(self, quantidade):
+        """Devolve (positivo) ou cobra (negativo) fichas após saber o consumo real"""
+        with self.lock:
+            self._repor()
+            self.fichas = min(self.capacidade, self.fichas + quantidade)
+
+class LLMGateway:
+    """Ponto único de acesso ao Gemini para todo o processo.
+
+    Cada chamada passa por: vaga de concorrência → cota de requisições e
+    tokens por minuto → tentativa com timeout igual ao prazo restante.
+    Erros repetíveis (429, 5xx, timeout, conexão) são repetidos com backoff
+    exponencial com jitter, respeitando Retry-After e o prazo da chamada.
+    """
+    def __init__(self, client, rpm, tpm, max_concorrencia, max_tentativas, prazo_s):
+        self.client = client
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.semaforo = threading.BoundedSemaphore(max_concorrencia)
+        self.max_concorrencia = max_concorrencia
+        self.max_tentativas = max_tentativas
+        self.prazo_s = prazo_s
+
+        self.metricas_lock = threading.Lock()
+        self.contadores = {"chamadas": 0, "sucessos": 0, "falhas": 0,
+                           "repeticoes": 0, "erros_429": 0, "prazos_esgotados": 0}
+        self.esperas = deque(maxlen=500)
+        self.latencias = deque(maxlen=500)
+
+    def _contar(self, nome):
+        with self.metricas_lock:
+            self.contadores[nome] += 1
+
+    def _estimar_tokens(self, contents, config):
+        saida = getattr(config, "max_output_tokens", None) or 0
+        return len(str(contents)) // LLM_CHARS_POR_TOKEN + saida
+
+    def _repetivel(self, erro):
+        if isinstance(erro, errors.APIError):
+            return erro.code in LLM_CODIGOS_REPETIVEIS
+        return isinstance(erro, (httpx.TimeoutException, httpx.TransportError))
+
+    def _backoff(self, tentativa, erro):
+        """Backoff exponencial com jitter completo; Retry-After do servidor tem prioridade"""
+        espera = random.uniform(0, min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * 2 ** tentativa))
+        resposta = getattr(erro, "response", None)
+        headers = getattr(resposta, "headers", None) or {}
+        try:
+            espera = max(espera, float(headers.get("retry-after")))
+        except (TypeError, ValueError):
+            pass
+        return espera
+
+    def generate(self, model, contents, config, prazo_s=None):
+        """Equivalente a client.models.generate_content com limites, retry e prazo"""
+        if self.client is None:
+            raise LLMIndisponivelError("Cliente Gemini não inicializado.")
+
+        inicio = time.monotonic()
+        prazo = inicio + (prazo_s if prazo_s is not None else self.prazo_s)
+        self._contar("chamadas")
+
+        if not self.semaforo.acquire(timeout=max(0, prazo - inicio)):
+            self._contar("prazos_esgotados")
+            self._contar("falhas")
+            raise LLMIndisponivelError("Prazo esgotado aguardando vaga de concorrência.")
+
+        try:
+            tokens_estimados = self._estimar_tokens(contents, config)
+            ultimo_erro = None
+            for tentativa in range(self.max_tentativas):
+                if not (self.rpm.consumir(1, prazo) and self.tpm.consumir(tokens_estimados, prazo)):
+                    ultimo_erro = "prazo esgotado aguardando cota de requisições/tokens"
+                    break
+                if tentativa == 0:
+                    with self.metricas_lock:
+                        self.esperas.append(time.monotonic() - inicio)
+
+                restante_ms = int((prazo - time.monotonic()) * 1000)
+                if restante_ms < LLM_TENTATIVA_MIN_MS:
+                    ultimo_erro = "prazo esgotado antes de uma nova tentativa"
+                    break
+                config_tentativa = config.model_copy(update={"http_options": types.HttpOptions(timeout=max(1, restante_ms))})
+                inicio_tentativa = time.monotonic()
+                try:
+                    response = self.client.models.generate_content(
+                        model=model, contents=contents, config=config_tentativa
+                    )
+                except Exception as e:
+                    if isinstance(e, errors.APIError) and e.code == 429:
+                        self._contar("erros_429")
+                    if not self._repetivel(e):
+                        self._contar("falhas")
+                        raise
+                    ultimo_erro = e
+                    espera = self._backoff(tentativa, e)
+                    if tentativa + 1 >= self.max_tentativas or time.monotonic() + espera >= prazo:
+                        break
+                    print(f"⚠️ Gemini: {e} — nova tentativa em {espera:.1f}s")
+                    self._contar("repeticoes")
+                    time.sleep(espera)
+                    continue
 
-state = AppState()
+                with self.metricas_lock:
+                    self.latencias.append(time.monotonic() - inicio_tentativa)
+                    self.contadores["sucessos"] += 1
+
+                uso = getattr(response, "usage_metadata", None)
+                if uso is not None and uso.total_token_count:
+                    self.tpm.ajustar(tokens_estimados - uso.total_token_count)
+                return response
+
+            if time.monotonic() >= prazo or isinstance(ultimo_erro, str):
+                self._contar("prazos_esgotados")
+            self._contar("falhas")
+            raise LLMIndisponivelError(f"Gemini indisponível: {ultimo_erro}")
+        finally:
+            self.semaforo.release()
+
+    def metricas(self):
+        """Contadores e percentis (em segundos) de espera na fila e latência"""
+        with self.metricas_lock:
+            resultado = dict(self.contadores)
+            amostras = {"espera_fila": list(self.esperas), "latencia": list(self.latencias)}
+        for nome, valores in amostras.items():
+            if valores:
+                resultado[f"{nome}_p50"] = float(np.percentile(valores, 50))
+                resultado[f"{nome}_p95"] = float(np.percentile(valores, 95))
+                resultado[f"{nome}_max"] = float(max(valores))
+        return resultado
+
+    def resumo_metricas(self):
+        m = self.metricas()
+        linhas = [
+            f"**Chamadas:** {m['chamadas']} | **Sucessos:** {m['sucessos']} | **Falhas:** {m['falhas']}",
+            f"**Repetições:** {m['repeticoes']} | **Erros 429:** {m['erros_429']} | "
+            f"**Prazos esgotados:** {m['prazos_esgotados']}",
+            f"**Limites:** {LLM_RPM} req/min, {LLM_TPM:,} tokens/min, {self.max_concorrencia} simultâneas",
+        ]
+        for nome, rotulo in (("espera_fila", "Espera na fila"), ("latencia", "Latência da API")):
+            if f"{nome}_p50" in m:
+                linhas.append(f"**{rotulo}:** p50 {m[f'{nome}_p50']:.2f}s | "
+                              f"p95 {m[f'{nome}_p95']:.2f}s | máx {m[f'{nome}_max']:.2f}s")
+        return "\n\n".join(linhas)
+
+llm_gateway = LLMGateway(client, LLM_RPM, LLM_TPM, LLM_MAX_CONCORRENCIA, LLM_MAX_TENTATIVAS, LLM_PRAZO_S)
+# Chamadas que podem terminar depois de quem as pediu (narrativas tardias)
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCORRENCIA, thread_name_prefix="llm")
+
+def remaining_time(prazo):
+    """Segundos até o prazo (time.monotonic); None se não há prazo"""
+    if prazo is None:
+        return None
+    return max(0.0, prazo - time.monotonic())
+
+# Matplotlib (pyplot) não é thread-safe; gráficos são gerados um por vez
+PLOT_LOCK = threading.Lock()
 
 # ===========================================================
 # FUNÇÕES AUXILIARES DE PARSE E EXTRAÇÃO
 # ===========================================================
-def parse_nfe(xml_path):
-    ns = {"nfe": "http://www.portalfiscal.inf.br/nfe"}
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    infNFe = root.find(".//nfe:infNFe", ns)
-    if infNFe is None:
-        raise ValueError("Estrutura de NF-e inválida")
+NS_NFE = {"nfe": "http://www.portalfiscal.inf.br/nfe"}
+NS_CTE = {"cte": "http://www.portalfiscal.inf.br/cte"}
+
+# Eventos de cancelamento e códigos de status que confirmam o registro na SEFAZ
+TP_EVENTO_CANCELAMENTO = "110111"
+CSTAT_EVENTO_REGISTRADO = ("135", "136", "155")
+CSTAT_CANCELAMENTO_HOMOLOGADO = ("101", "151", "155")
+
+MODELOS_DOCUMENTO = {"55": "NF-e", "65": "NFC-e", "57": "CT-e", "67": "CT-e OS"}
+
+def gettext(parent, path, ns):
+    if parent is None:
+        return None
+    elem = parent.find(path, ns)
+    return elem.text.strip() if elem is not None and elem.text else None
+
+def local_tag(elem):
+    return elem.tag.rsplit("}", 1)[-1]
+
+def namespace_uri(elem):
+    return elem.tag[1:].split("}", 1)[0] if elem.tag.startswith("{") else ""
+
+def extract_protocol(data, infProt, ns, prefix):
+    """Acrescenta os dados do protocolo de autorização (protNFe/protCTe), se houver"""
+    data["protocolo"] = gettext(infProt, f"{prefix}:nProt", ns)
+    data["status_sefaz"] = gettext(infProt, f"{prefix}:cStat", ns)
+    data["data_autorizacao"] = gettext(infProt, f"{prefix}:dhRecbto", ns)
+
+def extract_nfe(infNFe, infProt=None):
+    """Extrai NF-e (modelo 55) e NFC-e (modelo 65), que compartilham o layout"""
+    ns = NS_NFE
 
     def gettext_local(tag, parent):
-        elem = parent.find(f"nfe:{tag}", ns)
-        return elem.text.strip() if elem is not None and elem.text else None
+        return gettext(parent, f"nfe:{tag}", ns)
 
     ide = infNFe.find("nfe:ide", ns)
     emit = infNFe.find("nfe:emit", ns)
     dest = infNFe.find("nfe:dest", ns)
-    total = infNFe.find(".//nfe:total/nfe:ICMSTot", ns)
+    total = infNFe.find("nfe:total/nfe:ICMSTot", ns)
 
+    modelo = gettext_local("mod", ide)
     nfe_data = {
         "chave": infNFe.attrib.get("Id", ""),
+        "tipo_documento": MODELOS_DOCUMENTO.get(modelo, "NF-e"),
+        "versao": infNFe.attrib.get("versao"),
         "numero": gettext_local("nNF", ide),
-        "data_emissao": gettext_local("dhEmi", ide),
+        # Layouts até 2.00 usam dEmi (só data); 3.10+ usam dhEmi (data/hora com timezone)
+        "data_emissao": gettext_local("dhEmi", ide) or gettext_local("dEmi", ide),
         "natureza_operacao": gettext_local("natOp", ide),
-        "modelo": gettext_local("mod", ide),
+        "modelo": modelo,
         "serie": gettext_local("serie", ide),
         "tipo_operacao": gettext_local("tpNF", ide),
     }
@@ -77,12 +316,15 @@ def parse_nfe(xml_path):
         nfe_data["emitente_nome"] = gettext_local("xNome", emit)
 
     if dest is not None:
-        nfe_data["destinatario_cnpj"] = gettext_local("CNPJ", dest)
+        # NFC-e de consumidor final costuma trazer CPF (ou nada) no destinatário
+        nfe_data["destinatario_cnpj"] = gettext_local("CNPJ", dest) or gettext_local("CPF", dest)
         nfe_data["destinatario_nome"] = gettext_local("xNome", dest)
 
     if total is not None:
         nfe_data["valor_nf"] = gettext_local("vNF", total)
 
+    extract_protocol(nfe_data, infProt, ns, "nfe")
+
     itens = []
     for det in infNFe.findall("nfe:det", ns):
         prod = det.find("nfe:prod", ns)
@@ -103,6 +345,107 @@ def parse_nfe(xml_path):
     nfe_data["itens"] = json.dumps(itens, ensure_ascii=False)
     return nfe_data
 
+def extract_cte(infCte, infProt=None):
+    """Extrai CT-e / CT-e OS: o valor da prestação entra como valor do documento, sem itens"""
+    ns = NS_CTE
+    ide = infCte.find("cte:ide", ns)
+    emit = infCte.find("cte:emit", ns)
+    # CT-e OS não tem destinatário; a contraparte é o tomador do serviço
+    dest = infCte.find("cte:dest", ns)
+    if dest is None:
+        dest = infCte.find("cte:toma", ns)
+
+    modelo = gettext(ide, "cte:mod", ns)
+    cte_data = {
+        "chave": infCte.attrib.get("Id", ""),
+        "tipo_documento": MODELOS_DOCUMENTO.get(modelo, "CT-e"),
+        "versao": infCte.attrib.get("versao"),
+        "numero": gettext(ide, "cte:nCT", ns),
+        "data_emissao": gettext(ide, "cte:dhEmi", ns) or gettext(ide, "cte:dEmi", ns),
+        "natureza_operacao": gettext(ide, "cte:natOp", ns),
+        "modelo": modelo,
+        "serie": gettext(ide, "cte:serie", ns),
+        "tipo_operacao": None,
+        "emitente_cnpj": gettext(emit, "cte:CNPJ", ns),
+        "emitente_nome": gettext(emit, "cte:xNome", ns),
+        "destinatario_cnpj": gettext(dest, "cte:CNPJ", ns) or gettext(dest, "cte:CPF", ns),
+        "destinatario_nome": gettext(dest, "cte:xNome", ns),
+        "valor_nf": gettext(infCte, "cte:vPrest/cte:vTPrest", ns),
+        "itens": "[]",
+    }
+    extract_protocol(cte_data, infProt, ns, "cte")
+    return cte_data
+
+def parse_nfe_document(root):
+    if local_tag(root) == "nfeProc":
+        infNFe = root.find("nfe:NFe/nfe:infNFe", NS_NFE)
+    elif local_tag(root) == "NFe":
+        infNFe = root.find("nfe:infNFe", NS_NFE)
+    else:
+        # Raiz desconhecida (envelopes, lotes...): busca genérica pela NF-e
+        infNFe = root.find(".//nfe:infNFe", NS_NFE)
+    if infNFe is None:
+        raise ValueError("Estrutura de NF-e inválida")
+
+    data = extract_nfe(infNFe, root.find("nfe:protNFe/nfe:infProt", NS_NFE))
+    return ("nfce" if data["tipo_documento"] == "NFC-e" else "nfe"), data
+
+def parse_cte_document(root):
+    if local_tag(root) == "cteProc":
+        infCte = root.find("cte:CTe/cte:infCte", NS_CTE)
+    elif local_tag(root) == "cteOSProc":
+        infCte = root.find("cte:CTeOS/cte:infCte", NS_CTE)
+    else:
+        infCte = root.find("cte:infCte", NS_CTE)
+    if infCte is None:
+        raise ValueError("Estrutura de CT-e inválida")
+    return "cte", extract_cte(infCte, root.find("cte:protCTe/cte:infProt", NS_CTE))
+
+def parse_event_document(root):
+    """Eventos (procEventoNFe/procEventoCTe): cancelamento registrado ou outro evento"""
+    uri = namespace_uri(root)
+    ns = {"ev": uri}
+    if local_tag(root) == "evento":
+        infEvento = root.find("ev:infEvento", ns)
+    else:
+        infEvento = root.find("ev:evento/ev:infEvento", ns)
+    if infEvento is None:
+        raise ValueError("Estrutura de evento inválida")
+
+    chave = gettext(infEvento, "ev:chNFe", ns) or gettext(infEvento, "ev:chCTe", ns)
+    cstat = gettext(root, "ev:retEvento/ev:infEvento/ev:cStat", ns)
+    if gettext(infEvento, "ev:tpEvento", ns) == TP_EVENTO_CANCELAMENTO and cstat in CSTAT_EVENTO_REGISTRADO:
+        return "cancelamento", {"chave": chave}
+    return "evento", {"chave": chave}
+
+def parse_legacy_cancel_document(root):
+    """Cancelamento no layout antigo (procCancNFe, anterior aos eventos)"""
+    chave = gettext(root, "nfe:cancNFe/nfe:infCanc/nfe:chNFe", NS_NFE)
+    cstat = gettext(root, "nfe:retCancNFe/nfe:infCanc/nfe:cStat", NS_NFE)
+    if chave and cstat in CSTAT_CANCELAMENTO_HOMOLOGADO:
+        return "cancelamento", {"chave": chave}
+    return "evento", {"chave": chave}
+
+# Despacho pelo elemento raiz: cada XML é lido uma única vez
+DOCUMENT_PARSERS = {
+    "nfeProc": parse_nfe_document,
+    "NFe": parse_nfe_document,
+    "cteProc": parse_cte_document,
+    "CTe": parse_cte_document,
+    "cteOSProc": parse_cte_document,
+    "CTeOS": parse_cte_document,
+    "procEventoNFe": parse_event_document,
+    "procEventoCTe": parse_event_document,
+    "evento": parse_event_document,
+    "procCancNFe": parse_legacy_cancel_document,
+}
+
+def parse_document(xml_path):
+    """Classifica o XML pelo elemento raiz e devolve (tipo, dados) do extrator específico"""
+    root = ET.parse(xml_path).getroot()
+    parser = DOCUMENT_PARSERS.get(local_tag(root), parse_nfe_document)
+    return parser(root)
+
 def extract_archive(file_path, extract_to):
     if file_path.endswith(".zip"):
         with zipfile.ZipFile(file_path, "r") as zip_ref:
@@ -113,22 +456,501 @@ def extract_archive(file_path, extract_to):
     else:
         raise ValueError("Formato de arquivo não suportado. Use .zip ou .7z")
 
+# ===========================================================
+# INFERÊNCIA LOCAL DE ESQUEMA E FORMATOS DE DATA
+# ===========================================================
+SCHEMA_AMOSTRA = 200
+
+# Formatos de data conhecidos nas NF-e. `regex` classifica a amostra na
+# inferência; na conversão da coluna inteira, `tamanhos` + formato explícito
+# fazem o mesmo papel sem regex por linha. `fatia` corta o sufixo de timezone:
+# o mês de referência é o da data local de emissão, como impressa na nota
+DATE_FORMATS = {
+    "iso_tz": {
+        "regex": r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:[+-]\d{2}:?\d{2}|Z)$",
+        "formato": "%Y-%m-%dT%H:%M:%S",
+        "fatia": 19,
+        "tamanhos": (20, 24, 25),
+        "descricao": "ISO 8601 com timezone (dhEmi, layout 3.10+)",
+    },
+    "iso": {
+        "regex": r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$",
+        "formato": "%Y-%m-%dT%H:%M:%S",
+        "fatia": None,
+        "tamanhos": (19,),
+        "descricao": "ISO 8601 sem timezone",
+    },
+    "data": {
+        "regex": r"^\d{4}-\d{2}-\d{2}$",
+        "formato": "%Y-%m-%d",
+        "fatia": None,
+        "tamanhos": (10,),
+        "descricao": "Somente data (dEmi, layouts até 2.00)",
+    },
+    "data_br": {
+        "regex": r"^\d{2}/\d{2}/\d{4}$",
+        "formato": "%d/%m/%Y",
+        "fatia": None,
+        "tamanhos": (10,),
+        "descricao": "Data DD/MM/AAAA",
+    },
+}
+
+# Colunas numéricas que parecem códigos (zeros à esquerda, CNPJ, protocolo...) devem continuar texto
+CODE_COLUMNS = ("chave", "numero", "serie", "modelo", "tipo_operacao", "versao",
+                "emitente_cnpj", "destinatario_cnpj", "protocolo", "status_sefaz")
+
+schema_cache = {}
+schema_cache_lock = threading.Lock()
+
+def sample_column(series, n=SCHEMA_AMOSTRA):
+    valores = series.dropna()
+    if len(valores) > n:
+        valores = valores.sample(n=n, random_state=0)
+    return valores.astype(str).str.strip()
+
+def schema_fingerprint(df):
+    """Identifica o "formato" do dataset: colunas, versões de layout e forma das datas"""
+    versoes = sorted(df['versao'].dropna().astype(str).unique()) if 'versao' in df.columns else []
+    formas_data = []
+    if 'data_emissao' in df.columns:
+        formas_data = sorted(sample_column(df['data_emissao']).str.replace(r"\d", "9", regex=True).unique())
+    chave = json.dumps([list(df.columns), versoes, formas_data], ensure_ascii=False)
+    return hashlib.sha1(chave.encode("utf-8")).hexdigest()[:16]
+
+def infer_column_type(nome, valores):
+    if nome == 'itens':
+        return "json"
+    if nome in CODE_COLUMNS:
+        return "codigo"
+    if len(valores) == 0:
+        return "vazio"
+    if valores.str.fullmatch(r"-?\d+(?:\.\d+)?").all():
+        return "numerico"
+    padrao_datas = "|".join(f"(?:{fmt['regex']})" for fmt in DATE_FORMATS.values())
+    if valores.str.match(padrao_datas).all():
+        return "data"
+    return "texto"
+
+def infer_schema(df):
+    """Detecta versões de layout, formatos de data e tipos de coluna a partir de uma amostra.
+
+    O resultado é cacheado pela impressão digital do esquema, então datasets
+    com a mesma estrutura reaproveitam a inferência.
+    """
+    fingerprint = schema_fingerprint(df)
+    with schema_cache_lock:
+        if fingerprint in schema_cache:
+            return schema_cache[fingerprint]
+
+    datas = sample_column(df['data_emissao']) if 'data_emissao' in df.columns else pd.Series(dtype=str)
+    contagem = {}
+    for nome, fmt in DATE_FORMATS.items():
+        encontrados = int(datas.str.match(fmt["regex"]).sum())
+        if encontrados:
+            contagem[nome] = encontrados
+
+    schema = {
+        "fingerprint": fingerprint,
+        "versoes_layout": sorted(df['versao'].dropna().astype(str).unique()) if 'versao' in df.columns else [],
+        # Mais frequente primeiro: é o caminho rápido para a maioria das linhas
+        "formatos_data": sorted(contagem, key=lambda nome: -contagem[nome]),
+        "tipos_colunas": {col: infer_column_type(col, sample_column(df[col])) for col in df.columns},
+    }
+    with schema_cache_lock:
+        schema_cache[fingerprint] = schema
+
+    print(f"✓ Esquema inferido ({fingerprint}): layouts {schema['versoes_layout'] or '?'}, "
+          f"datas {[DATE_FORMATS[nome]['descricao'] for nome in schema['formatos_data']]}")
+    return schema
+
+def parse_emission_dates(series, schema):
+    """Converte datas de emissão com formato explícito (data/hora local de emissão, sem timezone)"""
+    # Texto de largura fixa: medir e truncar (remover timezone) são vetorizados pelo numpy
+    texto = series.to_numpy(dtype="U32")
+    tamanhos = np.char.str_len(texto)
+    resultado = np.full(len(series), np.datetime64("NaT"), dtype="datetime64[ns]")
+    pendentes = series.notna().to_numpy()
+
+    # Formatos da amostra primeiro; os demais conhecidos cobrem linhas fora da amostra
+    nomes = schema["formatos_data"] + [nome for nome in DATE_FORMATS if nome not in schema["formatos_data"]]
+    for nome in nomes:
+        fmt = DATE_FORMATS[nome]
+        mask = pendentes & np.isin(tamanhos, fmt["tamanhos"])
+        if not mask.any():
+            continue
+        valores = texto[mask].astype(f"U{fmt['fatia']}") if fmt["fatia"] else texto[mask]
+        convertidos = pd.to_datetime(valores, format=fmt["formato"], errors="coerce").to_numpy()
+        validos = ~np.isnat(convertidos)
+        posicoes = np.flatnonzero(mask)[validos]
+        resultado[posicoes] = convertidos[validos]
+        pendentes[posicoes] = False
+
+    # Último recurso, só para o que sobrou: remove o timezone e deixa o pandas deduzir
+    if pendentes.any():
+        restantes = series[pendentes].astype(str).str.strip()
+        restantes = restantes.str.replace(r"(?:[+-]\d{2}:?\d{2}|Z)$", "", regex=True)
+        resultado[pendentes] = pd.to_datetime(restantes, format="mixed", errors="coerce").to_numpy()
+        print(f"⚠️ {int(pendentes.sum())} data(s) em formato não reconhecido; "
+              f"{int(np.isnat(resultado[pendentes]).sum())} inválida(s)")
+
+    return pd.Series(resultado, index=series.index)
+
+# ===========================================================
+# ITENS DAS NOTAS (JSON DECODIFICADO UMA VEZ POR JOB)
+# ===========================================================
+ITEM_CAMPOS_TEXTO = ("item", "codigo", "descricao", "ncm", "cfop", "unidade")
+ITEM_CAMPOS_NUMERICOS = ("quantidade", "valor_unitario", "valor_total")
+
+def to_float_array(valores):
+    try:
+        return np.array(valores, dtype=float)
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(valores, dtype=object), errors="coerce").to_numpy(dtype=float)
+
+def decode_items(df):
+    """Decodifica a coluna JSON 'itens' uma única vez: um registro por item, em colunas.
+
+    `nota` é a posição da nota em `df`; campos numéricos viram float (NaN se
+    ausentes ou inválidos). Análise, gráficos e explorador leem desta tabela.
+    """
+    listas = []
+    for itens_str in df['itens']:
+        try:
+            itens = json.loads(itens_str) if isinstance(itens_str, str) else []
+        except ValueError:
+            itens = []
+        listas.append(itens if isinstance(itens, list) else [])
+
+    itens_por_nota = np.fromiter(map(len, listas), dtype=np.int64, count=len(listas))
+    itens = list(chain.from_iterable(listas))
+    colunas = {'nota': np.repeat(np.arange(len(df)), itens_por_nota)}
+    for campo in ITEM_CAMPOS_TEXTO:
+        colunas[campo] = [item.get(campo) for item in itens]
+    for campo in ITEM_CAMPOS_NUMERICOS:
+        colunas[campo] = to_float_array([item.get(campo) for item in itens])
+    return pd.DataFrame(colunas)
+
+# ===========================================================
+# NORMALIZAÇÃO DE DESCRIÇÕES DE ITENS
+# ===========================================================
+# Grafias de unidade de medida que viram um token só ("500 GR" -> "500G", "1,5 LTS" -> "1.5L")
+UNIDADES_MEDIDA = {
+    "KG": "KG", "KGS": "KG", "QUILO": "KG", "QUILOS": "KG",
+    "G": "G", "GR": "G", "GRS": "G", "GRAMA": "G", "GRAMAS": "G", "MG": "MG",
+    "L": "L", "LT": "L", "LTS": "L", "LITRO": "L", "LITROS": "L", "ML": "ML",
+    "M": "M", "MT": "M", "MTS": "M", "METRO": "M", "METROS": "M", "CM": "CM",
+    "MM": "MM", "MM2": "MM2", "W": "W", "V": "V",
+    "UN": "UN", "UND": "UN", "UNID": "UN", "UNIDADES": "UN",
+}
+# Unidades de venda soltas no fim da descrição ("DETERGENTE 500ML UN") não distinguem produtos
+UNIDADES_VENDA = {"UN", "UND", "UNID", "UNIDADE", "PC", "PCT", "CX", "FD", "FARDO"}
+
+RE_ABREVIACOES = re.compile(r"\b([CS])/")
+RE_DECIMAL = re.compile(r"(\d),(\d)")
+# Separador de milhar brasileiro ("1.000", "12.500,75"): grupos de exatamente 3 dígitos após o ponto
+RE_MILHAR = re.compile(r"(?<![\d.])[1-9]\d{0,2}(?:\.\d{3})+(?![\d.])")
+RE_PONTO_SOLTO = re.compile(r"(?<!\d)\.|\.(?!\d)")
+RE_PERCENTUAL = re.compile(r"(\d) +%")
+# Sem acentos o texto é ASCII: o que não for letra, dígito, ponto ou % vira espaço
+SEPARADORES = str.maketrans({chr(c): " " for c in range(128) if not (chr(c).isalnum() or chr(c) in ".%")})
+RE_MEDIDA = re.compile(r"(\d+(?:\.\d+)?) *(" + "|".join(sorted(UNIDADES_MEDIDA, key=len, reverse=True)) + r")\b")
+
+# Cache compartilhado entre análises: cada descrição distinta é normalizada uma vez por processo
+NORMALIZACAO_CACHE_MAX = 1_000_000
+
+description_cache = {}
+description_cache_lock = threading.Lock()
+
+def normalize_measure(match):
+    numero = match.group(1)
+    if "." in numero:
+        numero = numero.rstrip("0").rstrip(".")
+    return f"{numero}{UNIDADES_MEDIDA[match.group(2)]}"
+
+def normalize_description(desc):
+    """Forma canônica de uma descrição: sem acentos, maiúscula, pontuação, espaços e unidades padronizados"""
+    texto = unicodedata.normalize("NFKD", desc).encode("ascii", "ignore").decode("ascii").upper()
+    # Cada regex custa microssegundos mesmo sem casar: só roda se o caractere-chave aparece
+    if "/" in texto:
+        texto = RE_ABREVIACOES.sub(lambda m: "COM " if m.group(1) == "C" else "SEM ", texto)
+    # Milhar sai antes de a vírgula decimal virar ponto, senão "1.000,5" ficaria ambíguo
+    if "." in texto:
+        texto = RE_MILHAR.sub(lambda m: m.group(0).replace(".", ""), texto)
+    if "," in texto:
+        texto = RE_DECIMAL.sub(r"\1.\2", texto)
+    texto = texto.translate(SEPARADORES)
+    if "." in texto:
+        texto = RE_PONTO_SOLTO.sub(" ", texto)
+    if "%" in texto:
+        texto = RE_PERCENTUAL.sub(r"\1%", texto)
+    texto = RE_MEDIDA.sub(normalize_measure, texto)
+    tokens = texto.split()
+    while len(tokens) > 1 and tokens[-1] in UNIDADES_VENDA and not tokens[-2].replace(".", "").isdigit():
+        tokens.pop()
+    return " ".join(tokens)
+
+def normalize_descriptions(distintas):
+    """Normaliza descrições distintas, reaproveitando o cache entre análises"""
+    with description_cache_lock:
+        normalizadas = [description_cache.get(desc) for desc in distintas]
+
+    novas = {}
+    for i, normalizada in enumerate(normalizadas):
+        if normalizada is None:
+            normalizadas[i] = novas[distintas[i]] = normalize_description(distintas[i])
+
+    if novas:
+        with description_cache_lock:
+            if len(description_cache) + len(novas) > NORMALIZACAO_CACHE_MAX:
+                description_cache.clear()
+            description_cache.update(novas)
+    return np.array(normalizadas, dtype=object)
+
+# Acima disso, o código do fornecedor é genérico (cProd constante) e não identifica produto
+PRODUTO_MAX_VARIANTES_CODIGO = 4
+
+def most_frequent_by_group(grupos, valores, n_valores, prioridade=None):
+    """Valor mais frequente de cada grupo (inteiros); empates pela maior `prioridade` do valor.
+
+    Devolve (grupos, valores) alinhados, um par por grupo presente.
+    """
+    par_codigos, pares = pd.factorize(grupos.astype(np.int64) * n_valores + valores)
+    contagem = np.bincount(par_codigos)
+    par_grupo, par_valor = pares // n_valores, pares % n_valores
+    if prioridade is None:
+        ordem = np.lexsort((-contagem, par_grupo))
+    else:
+        ordem = np.lexsort((-prioridade[par_valor], -contagem, par_grupo))
+    primeiros = ordem[np.r_[True, par_grupo[ordem][1:] != par_grupo[ordem][:-1]]]
+    return par_grupo[primeiros], par_valor[primeiros]
+
+def item_products(df, itens):
+    """Um registro por item com valor positivo e a chave de produto normalizada.
+
+    A chave é a descrição canônica mais a posição SH do NCM (4 dígitos), que
+    separa produtos homônimos sem se abalar com erros de subitem; item sem
+    NCM herda a posição mais comum do produto. Itens com o mesmo código no
+    mesmo fornecedor recebem uma só descrição canônica, a variante mais
+    frequente daquele código, desde que o código tenha no máximo
+    PRODUTO_MAX_VARIANTES_CODIGO variantes e a variante comece como a
+    canônica (3 primeiras letras). O agrupamento é feito sobre códigos inteiros.
+    `itens` é a tabela de decode_items(df); o índice do resultado é a
+    posição do item nela e `nota`, a posição da nota em `df`.
+    """
+    # Fornecedor codificado por nota e repetido por item
+    cnpj_por_nota, cnpj_distintos = pd.factorize(df['emitente_cnpj'])
+    nota = itens['nota'].to_numpy()
+    valor = itens['valor_total'].to_numpy()
+    desc_codigos, distintas = pd.factorize(itens['descricao'].to_numpy(dtype=object))
+
+    # Normalização por descrição distinta; depois, só índices inteiros. Sem
+    # descrição (código -1) cai no "" acrescentado ao fim, descartado abaixo
+    normalizadas = np.append(normalize_descriptions(distintas), "")
+    produto_por_desc, produtos = pd.factorize(normalizadas)
+    produto = produto_por_desc[desc_codigos]
+    validos = (desc_codigos >= 0) & (valor > 0) & (produtos[produto] != "")
+
+    # Mesmo código no mesmo fornecedor: descrição canônica mais frequente
+    cnpj_codigos = cnpj_por_nota[nota]
+    cod_codigos, cod_distintos = pd.factorize(itens['codigo'].to_numpy(dtype=object))
+    # Ausentes (código -1) caem no False acrescentado ao fim
+    cnpj_presente = np.append(cnpj_distintos.to_numpy(dtype=object) != "", False)[cnpj_codigos]
+    codigo_presente = np.append(cod_distintos != "", False)[cod_codigos]
+    com_codigo = validos & cnpj_presente & codigo_presente
+    if com_codigo.any():
+        fornecedor_codigo, _ = pd.factorize(
+            cnpj_codigos[com_codigo].astype(np.int64) * (len(cod_distintos) + 1) + cod_codigos[com_codigo])
+        variantes_codigo = produto[com_codigo]
+        # Empate entre variantes: vence a descrição mais usada no dataset inteiro
+        frequencia = np.bincount(produto[validos], minlength=len(produtos))
+        grupos, canonicos = most_frequent_by_group(fornecedor_codigo, variantes_codigo, len(produtos), frequencia)
+        canonico = np.empty(fornecedor_codigo.max() + 1, dtype=produto.dtype)
+        canonico[grupos] = canonicos
+        canonico = canonico[fornecedor_codigo]
+
+        # Só unifica variantes que concordam: código com poucas variantes e mesmo início de descrição
+        _, pares = pd.factorize(fornecedor_codigo.astype(np.int64) * len(produtos) + variantes_codigo)
+        n_variantes = np.bincount(pares // len(produtos), minlength=len(grupos))
+        prefixo, _ = pd.factorize(np.array([p.split(" ", 1)[0][:3] for p in produtos], dtype=object))
+        unificar = ((n_variantes[fornecedor_codigo] <= PRODUTO_MAX_VARIANTES_CODIGO)
+                    & (prefixo[canonico] == prefixo[variantes_codigo]))
+        produto[np.flatnonzero(com_codigo)[unificar]] = canonico[unificar]
+
+    # Posição SH por NCM distinto; NCM ausente (código -1) cai no "" acrescentado ao fim
+    ncm_codigos, ncm_distintos = pd.factorize(itens['ncm'].to_numpy(dtype=object))
+    posicoes = np.array([str(ncm)[:4] for ncm in ncm_distintos] + [""], dtype=object)
+    posicao_por_ncm, posicoes_distintas = pd.factorize(posicoes)
+    posicao = posicao_por_ncm[ncm_codigos]
+
+    # Item sem NCM herda a posição mais comum do mesmo produto
+    sem_posicao = posicao == posicao_por_ncm[-1]
+    com_posicao = validos & ~sem_posicao
+    if (validos & sem_posicao).any() and com_posicao.any():
+        grupos, posicoes_comuns = most_frequent_by_group(produto[com_posicao], posicao[com_posicao],
+                                                         len(posicoes_distintas))
+        herdada = np.full(len(produtos), posicao_por_ncm[-1], dtype=posicao.dtype)
+        herdada[grupos] = posicoes_comuns
+        posicao[sem_posicao] = herdada[produto[sem_posicao]]
+
+    chave_produto, _ = pd.factorize(produto[validos].astype(np.int64) * len(posicoes_distintas) + posicao[validos])
+
+    return pd.DataFrame({
+        'nota': nota[validos],
+        'descricao': distintas[desc_codigos[validos]],
+        'produto': produtos[produto[validos]],
+        'chave_produto': chave_produto,
+        'valor_total': valor[validos],
+    }, index=np.flatnonzero(validos))
+
 # ===========================================================
 # ANÁLISE COM GEMINI E GERAÇÃO DE GRÁFICOS
 # ===========================================================
-def generate_monthly_spending_chart(df):
+# Saída dos gráficos: "nativo" envia só as séries agregadas para os gráficos
+# do Gradio (PNG sob demanda); "png" também renderiza as imagens na análise
+GRAFICOS_MODO = os.environ.get("IGUACU_GRAFICOS_MODO", "nativo")
+GRAFICOS_TOP_ITENS = 10
+# Produtos de maior valor guardados por mês para recalcular o top de um período
+GRAFICOS_TOP_CANDIDATOS = 50
+
+# Fatores médios de emissão por categoria (kg CO2 / R$)
+EMISSION_FACTORS = {
+    'alimentos': 0.5,
+    'eletrônicos': 1.2,
+    'construção': 0.8,
+    'limpeza': 0.3,
+    'vestuário': 0.6,
+    'móveis': 0.7,
+    'outros': 0.5
+}
+
+# Palavras-chave de cada categoria, na ordem de prioridade (uma regex por categoria)
+CATEGORIAS_ITENS = [
+    (categoria, re.compile("|".join(map(re.escape, palavras))))
+    for categoria, palavras in [
+        ('alimentos', ['aliment', 'comida', 'cafe', 'arroz', 'feijao', 'massa', 'leite', 'oleo', 'acucar']),
+        ('eletrônicos', ['eletro', 'cabo', 'lamp', 'camera', 'monitor', 'tomada', 'condutor']),
+        ('construção', ['cimento', 'massa corrida', 'tinta', 'areia', 'cano', 'tubo', 'registro']),
+        ('limpeza', ['limpeza', 'detergente', 'sabao', 'desinfetante', 'alcool', 'hipoclorito']),
+        ('vestuário', ['camiseta', 'calca', 'uniforme', 'jaleco', 'bota', 'luva']),
+        ('móveis', ['movel', 'cadeira', 'mesa']),
+    ]
+]
+
+def categorize_item(desc):
+    desc_lower = desc.lower()
+    for categoria, palavras in CATEGORIAS_ITENS:
+        if palavras.search(desc_lower):
+            return categoria
+    return 'outros'
+
+def monthly_spending_series(df):
+    """Série de gastos mensais: colunas mes_ano, valor_nf"""
+    if 'mes_ano' not in df.columns:
+        print("✗ Coluna 'mes_ano' não encontrada")
+        return pd.DataFrame(columns=['mes_ano', 'valor_nf'])
+    monthly = df.groupby('mes_ano')['valor_nf'].sum().reset_index()
+    return monthly.sort_values('mes_ano').reset_index(drop=True)
+
+def top_items_series(df, itens, meses, n=GRAFICOS_TOP_ITENS, candidatos=GRAFICOS_TOP_CANDIDATOS):
+    """Produtos de maior valor (descrições normalizadas), no total e por mês.
+
+    `itens` é a tabela de decode_items(df) e `meses`, o mes_ano de cada nota
+    de `df` (posicional; nulo sem data).
+    Devolve (top n do dataset: colunas descricao, valor; valores mensais dos
+    `candidatos` produtos de maior valor de cada mês: colunas produto,
+    descricao, mes_ano, valor), a segunda para recalcular o top de um período.
+    """
+    itens = item_products(df, itens)
+    if len(itens) == 0:
+        return (pd.DataFrame(columns=['descricao', 'valor']),
+                pd.DataFrame(columns=['produto', 'descricao', 'mes_ano', 'valor']))
+
+    top = itens.groupby('chave_produto', sort=False)['valor_total'].sum().nlargest(n)
+    itens['mes_ano'] = np.asarray(meses, dtype=object)[itens['nota'].to_numpy()]
+    por_mes = itens.groupby(['mes_ano', 'chave_produto'], sort=False)['valor_total'].sum()
+    escolhidos = por_mes.sort_values(ascending=False).groupby(level='mes_ano').head(candidatos)
+    mensal = por_mes[por_mes.index.get_level_values('chave_produto')
+                     .isin(escolhidos.index.get_level_values('chave_produto'))].reset_index()
+
+    # Rótulo de cada produto: a grafia original mais frequente entre as variantes
+    variantes = itens[itens['chave_produto'].isin(top.index) | itens['chave_produto'].isin(mensal['chave_produto'])]
+    rotulos = (variantes.groupby(['chave_produto', 'descricao']).size()
+               .reset_index(name='n').sort_values('n', ascending=False, kind='stable')
+               .drop_duplicates('chave_produto').set_index('chave_produto')['descricao']
+               .str.strip().str.upper())
+    top = pd.DataFrame({
+        'descricao': rotulos.reindex(top.index).to_numpy(),
+        'valor': top.to_numpy(),
+    })
+    mensal = pd.DataFrame({
+        'produto': mensal['chave_produto'].astype(int),
+        'descricao': rotulos.reindex(mensal['chave_produto']).to_numpy(),
+        'mes_ano': mensal['mes_ano'],
+        'valor': mensal['valor_total'],
+    }).sort_values(['mes_ano', 'valor'], ascending=[True, False], kind='stable')
+    return top, mensal
+
+def co2_emissions_series(itens, meses):
+    """Estima emissões de CO2 por mês; devolve (série mes_ano/co2_kg, co2_summary).
+
+    `itens` é a tabela de decode_items e `meses`, o mes_ano de cada nota
+    (posicional; notas sem data ficam de fora).
+    """
+    meses = pd.Series(meses, dtype=object)
+    mes = meses.to_numpy()[itens['nota'].to_numpy()]
+    validos = pd.notna(mes) & (itens['valor_total'].to_numpy() > 0)
+
+    # Categoria (e fator) por descrição distinta, não por item
+    desc_codigos, distintas = pd.factorize(itens['descricao'].fillna('').to_numpy(dtype=object)[validos])
+    categorias = np.array([categorize_item(desc) for desc in distintas], dtype=object)
+    fatores = np.array([EMISSION_FACTORS[categoria] for categoria in categorias])
+    co2 = itens['valor_total'].to_numpy()[validos] * fatores[desc_codigos]
+    por_categoria = pd.Series(co2).groupby([mes[validos], categorias[desc_codigos]]).sum()
+
+    monthly_details = {str(mes_str): {} for mes_str in sorted(meses.dropna().unique())}
+    for (mes_str, categoria), valor in por_categoria.items():
+        monthly_details[mes_str][categoria] = float(valor)
+    monthly_co2 = [{'mes_ano': mes_str, 'co2_kg': sum(categoria_co2.values())}
+                   for mes_str, categoria_co2 in monthly_details.items()]
+
+    if not monthly_co2:
+        print("✗ Nenhum dado de CO2 calculado")
+        return pd.DataFrame(columns=['mes_ano', 'co2_kg']), {}
+
+    co2_df = pd.DataFrame(monthly_co2).sort_values('mes_ano').reset_index(drop=True)
+
+    # Calcular totais
+    total_co2 = co2_df['co2_kg'].sum()
+    co2_summary = {
+        'total_kg': total_co2,
+        'total_ton': total_co2 / 1000,
+        'monthly_data': co2_df.to_dict('records'),
+        'category_details': monthly_details,
+        'emission_factors': EMISSION_FACTORS
+    }
+    print(f"  Total CO2: {total_co2:.2f} kg ({total_co2/1000:.3f} ton)")
+    return co2_df, co2_summary
+
+def build_chart_series(df_plot, df_work, itens):
+    """Calcula as séries agregadas dos três gráficos (pequenas, serializáveis em JSON)"""
+    monthly = monthly_spending_series(df_plot)
+    # Mês de cada nota de df_work (notas sem data ficam fora dos tops mensais)
+    meses = df_plot['mes_ano'].reindex(df_work.index).to_numpy(dtype=object)
+    top_items, top_items_mensal = top_items_series(df_work, itens, meses)
+    co2_df, co2_summary = co2_emissions_series(itens, meses)
+    series = {
+        'gastos_mensais': monthly.to_dict('records'),
+        'top_itens': top_items.to_dict('records'),
+        'top_itens_mensal': top_items_mensal.to_dict('records'),
+        'co2_mensal': co2_df.to_dict('records'),
+    }
+    print(f"✓ Séries dos gráficos: {len(monthly)} meses, {len(top_items)} itens, {len(co2_df)} meses de CO2")
+    return series, co2_summary
+
+def render_monthly_spending_chart(monthly, output_dir=None):
     """Gera histograma de gastos mensais"""
     try:
-        df_copy = df.copy()
-        
-        # Usar coluna já processada
-        if 'mes_ano' not in df_copy.columns:
-            print("✗ Coluna 'mes_ano' não encontrada")
-            return None
-            
-        monthly = df_copy.groupby('mes_ano')['valor_nf'].sum().reset_index()
-        monthly = monthly.sort_values('mes_ano')
-        
         if len(monthly) == 0:
             print("✗ Nenhum dado mensal para plotar")
             return None
@@ -152,7 +974,7 @@ def generate_monthly_spending_chart(df):
         plt.setp(ax.xaxis.get_majorticklabels(), rotation=45, ha='right')
         plt.tight_layout()
         
-        path = os.path.join(tempfile.gettempdir(), "monthly_spending.png")
+        path = os.path.join(output_dir or tempfile.gettempdir(), "monthly_spending.png")
         plt.savefig(path, dpi=150, bbox_inches="tight")
         plt.close(fig)
         
@@ -164,32 +986,19 @@ def generate_monthly_spending_chart(df):
         traceback.print_exc()
         return None
 
-def generate_top_items_chart(df):
+def short_description(desc, limite=60):
+    return desc[:limite] + '...' if len(desc) > limite else desc
+
+def render_top_items_chart(top_items, output_dir=None):
     """Gera gráfico dos top 10 itens mais comprados"""
     try:
-        all_items = []
-        for itens_str in df['itens'].dropna():
-            try:
-                itens = json.loads(itens_str)
-                for item in itens:
-                    desc = item.get('descricao', '').upper().strip()
-                    valor = float(item.get('valor_total', 0))
-                    if desc and valor > 0:
-                        all_items.append({'descricao': desc, 'valor': valor})
-            except:
-                continue
-        
-        if not all_items:
+        if len(top_items) == 0:
             print("✗ Nenhum item válido encontrado")
             return None
-            
-        items_df = pd.DataFrame(all_items)
-        top_items = items_df.groupby('descricao')['valor'].sum().nlargest(10).reset_index()
         
         # Truncar nomes longos
-        top_items['descricao_curta'] = top_items['descricao'].apply(
-            lambda x: x[:60] + '...' if len(x) > 60 else x
-        )
+        top_items = top_items.copy()
+        top_items['descricao_curta'] = top_items['descricao'].apply(short_description)
         
         fig, ax = plt.subplots(figsize=(14, 8))
         bars = ax.barh(top_items['descricao_curta'], top_items['valor'], 
@@ -209,7 +1018,7 @@ def generate_top_items_chart(df):
         ax.grid(axis='x', alpha=0.3, linestyle='--')
         plt.tight_layout()
         
-        path = os.path.join(tempfile.gettempdir(), "top_items.png")
+        path = os.path.join(output_dir or tempfile.gettempdir(), "top_items.png")
         plt.savefig(path, dpi=150, bbox_inches="tight")
         plt.close(fig)
         
@@ -221,74 +1030,12 @@ def generate_top_items_chart(df):
         traceback.print_exc()
         return None
 
-def estimate_co2_emissions(df):
-    """Estima emissões de CO2 baseado em categorias de produtos"""
+def render_co2_chart(co2_df, output_dir=None):
+    """Gera gráfico de linha das emissões de CO2 mensais"""
     try:
-        # Fatores médios de emissão por categoria (kg CO2 / R$)
-        emission_factors = {
-            'alimentos': 0.5,
-            'eletrônicos': 1.2,
-            'construção': 0.8,
-            'limpeza': 0.3,
-            'vestuário': 0.6,
-            'móveis': 0.7,
-            'outros': 0.5
-        }
-        
-        def categorize_item(desc):
-            desc_lower = desc.lower()
-            if any(word in desc_lower for word in ['aliment', 'comida', 'cafe', 'arroz', 'feijao', 'massa', 'leite', 'oleo', 'acucar']):
-                return 'alimentos'
-            elif any(word in desc_lower for word in ['eletro', 'cabo', 'lamp', 'camera', 'monitor', 'tomada', 'condutor']):
-                return 'eletrônicos'
-            elif any(word in desc_lower for word in ['cimento', 'massa corrida', 'tinta', 'areia', 'cano', 'tubo', 'registro']):
-                return 'construção'
-            elif any(word in desc_lower for word in ['limpeza', 'detergente', 'sabao', 'desinfetante', 'alcool', 'hipoclorito']):
-                return 'limpeza'
-            elif any(word in desc_lower for word in ['camiseta', 'calca', 'uniforme', 'jaleco', 'bota', 'luva']):
-                return 'vestuário'
-            elif any(word in desc_lower for word in ['movel', 'cadeira', 'mesa']):
-                return 'móveis'
-            return 'outros'
-        
-        df_copy = df.copy()
-        
-        # Usar coluna já processada
-        if 'mes_ano' not in df_copy.columns:
-            print("✗ Coluna 'mes_ano' não encontrada para CO2")
-            return None, {}
-        
-        monthly_co2 = []
-        monthly_details = {}
-        
-        for mes in sorted(df_copy['mes_ano'].dropna().unique()):
-            mes_data = df_copy[df_copy['mes_ano'] == mes]
-            total_co2 = 0
-            categoria_co2 = {}
-            
-            for itens_str in mes_data['itens'].dropna():
-                try:
-                    itens = json.loads(itens_str)
-                    for item in itens:
-                        desc = item.get('descricao', '')
-                        valor = float(item.get('valor_total', 0))
-                        if valor > 0:
-                            categoria = categorize_item(desc)
-                            co2 = valor * emission_factors[categoria]
-                            total_co2 += co2
-                            categoria_co2[categoria] = categoria_co2.get(categoria, 0) + co2
-                except:
-                    continue
-            
-            mes_str = str(mes)
-            monthly_co2.append({'mes_ano': mes_str, 'co2_kg': total_co2})
-            monthly_details[mes_str] = categoria_co2
-        
-        if not monthly_co2:
-            print("✗ Nenhum dado de CO2 calculado")
-            return None, {}
-            
-        co2_df = pd.DataFrame(monthly_co2).sort_values('mes_ano')
+        if len(co2_df) == 0:
+            print("✗ Nenhum dado de CO2 para plotar")
+            return None
         
         fig, ax = plt.subplots(figsize=(14, 7))
         
@@ -317,35 +1064,39 @@ def estimate_co2_emissions(df):
         plt.setp(ax.xaxis.get_majorticklabels(), rotation=45, ha='right')
         plt.tight_layout()
         
-        path = os.path.join(tempfile.gettempdir(), "co2_emissions.png")
+        path = os.path.join(output_dir or tempfile.gettempdir(), "co2_emissions.png")
         plt.savefig(path, dpi=150, bbox_inches="tight")
         plt.close(fig)
         
-        # Calcular totais
-        total_co2 = co2_df['co2_kg'].sum()
-        co2_summary = {
-            'total_kg': total_co2,
-            'total_ton': total_co2 / 1000,
-            'monthly_data': co2_df.to_dict('records'),
-            'category_details': monthly_details,
-            'emission_factors': emission_factors
-        }
-        
         print(f"✓ Gráfico CO2 gerado: {len(co2_df)} meses")
-        print(f"  Total CO2: {total_co2:.2f} kg ({total_co2/1000:.3f} ton)")
-        
-        return path, co2_summary
+        return path
     except Exception as e:
-        print(f"✗ Erro ao estimar CO2: {e}")
+        print(f"✗ Erro ao gerar gráfico de CO2: {e}")
         import traceback
         traceback.print_exc()
-        return None, {}
+        return None
 
-def call_gemini_analysis(prompt, data_summary):
-    """Chama API Gemini para análise"""
-    if client is None:
-        return "Erro: Cliente Gemini não inicializado."
-    
+def chart_frames(series):
+    """Converte as séries serializadas (registros JSON) em DataFrames"""
+    return {
+        'gastos_mensais': pd.DataFrame(series.get('gastos_mensais', []), columns=['mes_ano', 'valor_nf']),
+        'top_itens': pd.DataFrame(series.get('top_itens', []), columns=['descricao', 'valor']),
+        'top_itens_mensal': pd.DataFrame(series.get('top_itens_mensal', []),
+                                         columns=['produto', 'descricao', 'mes_ano', 'valor']),
+        'co2_mensal': pd.DataFrame(series.get('co2_mensal', []), columns=['mes_ano', 'co2_kg']),
+    }
+
+def render_chart_pngs(frames, output_dir=None):
+    """Renderiza os três PNGs a partir das séries agregadas (pyplot serializado)"""
+    with PLOT_LOCK:
+        return [
+            render_monthly_spending_chart(frames['gastos_mensais'], output_dir),
+            render_top_items_chart(frames['top_itens'], output_dir),
+            render_co2_chart(frames['co2_mensal'], output_dir),
+        ]
+
+def generate_gemini_analysis(prompt, data_summary, prazo_s=None):
+    """Chama API Gemini para análise (via gateway compartilhado); levanta exceção em falha"""
     full_prompt = f"""Você é um analista de dados especializado em Notas Fiscais eletrônicas brasileiras (NF-e).
 
 CONTEXTO DOS DADOS:
@@ -356,60 +1107,151 @@ TAREFA:
 
 Forneça uma análise detalhada, profissional e objetiva."""
 
-    try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=full_prompt,
-            config=types.GenerateContentConfig(
-                temperature=0.7,
-                max_output_tokens=4000
-            )
-        )
-        return response.text
-    except Exception as e:
-        return f"Erro ao chamar API Gemini: {str(e)}"
-
-def analyze_data_structure_with_gemini(df):
-    """Usa Gemini para analisar estrutura dos dados e sugerir melhor forma de processar datas"""
-    try:
-        sample_dates = df['data_emissao'].head(10).tolist()
-        sample_data = df.head(5).to_dict('records')
-        
-        structure_prompt = f"""Analise a estrutura deste dataset de Notas Fiscais e responda OBJETIVAMENTE:
-
-AMOSTRA DE DATAS:
-{sample_dates}
-
-AMOSTRA DE REGISTROS:
-{json.dumps(sample_data, indent=2, ensure_ascii=False)[:1000]}
-
-PERGUNTAS:
-1. Qual o formato exato das datas? (ex: ISO 8601 com timezone)
-2. Como extrair mês e ano dessas datas em Python/Pandas?
-3. Há datas inválidas ou nulas que precisam ser tratadas?
-4. Qual a melhor estratégia para agrupar por mês/ano?
+    response = llm_gateway.generate(
+        model="gemini-2.0-flash-exp",
+        contents=full_prompt,
+        config=types.GenerateContentConfig(
+            temperature=0.7,
+            max_output_tokens=4000
+        ),
+        prazo_s=prazo_s
+    )
+    if not response.text:
+        raise LLMIndisponivelError("Resposta vazia do Gemini.")
+    return response.text
 
-Seja TÉCNICO e DIRETO. Responda em formato de código Python quando aplicável."""
+def call_gemini_analysis(prompt, data_summary):
+    """Chama API Gemini para análise; devolve o texto de erro em caso de falha"""
+    if client is None:
+        return "Erro: Cliente Gemini não inicializado."
 
-        response = call_gemini_analysis(structure_prompt, "")
-        print("\n🤖 Análise Gemini da estrutura:")
-        print(response[:500])
-        
-        return response
+    try:
+        return generate_gemini_analysis(prompt, data_summary)
     except Exception as e:
-        print(f"Erro na análise de estrutura: {e}")
-        return None
+        return f"Erro ao chamar API Gemini: {str(e)}"
 
-def perform_autonomous_analysis(df):
-    """Executa análise autônoma completa"""
+RELATORIO_MAX_LACUNAS = 6
+
+def monthly_series(valores):
+    """Série mensal no período completo, com 0 nos meses sem notas"""
+    periodo = pd.period_range(min(valores.index), max(valores.index), freq='M').strftime('%Y-%m')
+    return valores.reindex(periodo, fill_value=0)
+
+def month_gaps(meses, presentes):
+    """Meses ausentes em `presentes`, resumidos em intervalos ('2023-03 a 2023-05')"""
+    intervalos = []
+    for posicao, mes in enumerate(meses):
+        if mes in presentes:
+            continue
+        if intervalos and intervalos[-1][2] == posicao - 1:
+            intervalos[-1][1:] = [mes, posicao]
+        else:
+            intervalos.append([mes, mes, posicao])
+    textos = [inicio if inicio == fim else f"{inicio} a {fim}" for inicio, fim, _ in intervalos]
+    if len(textos) > RELATORIO_MAX_LACUNAS:
+        textos = textos[:RELATORIO_MAX_LACUNAS] + [f"e mais {len(textos) - RELATORIO_MAX_LACUNAS} intervalo(s)"]
+    return textos
+
+def build_local_report(monthly_stats, gastos_fornecedor, co2_summary):
+    """Relatório determinístico calculado só com as estatísticas locais (modo degradado)"""
+    linhas = []
+    totais = monthly_stats.set_index('Mês/Ano')['Total (R$)']
+    # Tendência e variações sobre o calendário completo: mês sem nota conta como R$ 0
+    serie = monthly_series(totais)
+
+    # 1. Tendência mensal
+    linhas.append("### 1. Tendência mensal de gastos")
+    linhas.append(f"- Maior gasto: **{totais.idxmax()}** (R$ {totais.max():,.2f}); "
+                  f"menor gasto: **{totais.idxmin()}** (R$ {totais.min():,.2f})")
+    if len(serie) >= 2:
+        media = serie.mean()
+        inclinacao = np.polyfit(np.arange(len(serie)), serie.values, 1)[0]
+        relativa = inclinacao / media if media else 0.0
+        if relativa > 0.02:
+            tendencia = "crescimento"
+        elif relativa < -0.02:
+            tendencia = "redução"
+        else:
+            tendencia = "estabilidade"
+        linhas.append(f"- Tendência linear: **{tendencia}** de R$ {inclinacao:,.2f} por mês "
+                      f"({relativa:+.1%} da média mensal de R$ {media:,.2f})")
+        if totais.iloc[0]:
+            linhas.append(f"- Variação do primeiro ao último mês ({totais.index[0]} → {totais.index[-1]}): "
+                          f"{totais.iloc[-1] / totais.iloc[0] - 1:+.1%}")
+
+    if len(serie) > len(totais):
+        linhas.append(f"- {len(serie) - len(totais)} mês(es) sem notas fiscais no período (contados como R$ 0): "
+                      f"{', '.join(month_gaps(serie.index, totais.index))}")
+
+    medias = monthly_stats['Média (R$)']
+    if len(medias) >= 2 and medias.mean():
+        linhas.append(f"- Valor médio por NF varia de R$ {medias.min():,.2f} a R$ {medias.max():,.2f} "
+                      f"(coeficiente de variação {medias.std() / medias.mean():.0%})")
+
+    # 2. Maiores variações mês a mês
+    variacoes = serie.pct_change().replace([np.inf, -np.inf], np.nan).dropna()
+    if len(variacoes):
+        linhas.append("\n### 2. Maiores variações mês a mês")
+        for mes in variacoes.abs().sort_values(ascending=False, kind='stable').head(3).index:
+            anterior = serie.index[serie.index.get_loc(mes) - 1]
+            linhas.append(f"- {anterior} → {mes}: {variacoes[mes]:+.1%} "
+                          f"(R$ {serie[anterior]:,.2f} → R$ {serie[mes]:,.2f})")
+
+    # 3. Concentração de fornecedores
+    total_fornecedores = gastos_fornecedor.sum()
+    if total_fornecedores:
+        participacao = gastos_fornecedor / total_fornecedores
+        top3 = participacao.head(3).sum()
+        hhi = (participacao ** 2).sum() * 10000
+        nivel = "alta" if hhi > 2500 else "moderada" if hhi > 1500 else "baixa"
+        linhas.append("\n### 3. Concentração de fornecedores")
+        linhas.append(f"- {len(gastos_fornecedor)} fornecedores; os 3 maiores concentram **{top3:.1%}** do valor")
+        linhas.append(f"- Índice Herfindahl-Hirschman (HHI): {hhi:,.0f} — concentração **{nivel}**")
+        for nome, fracao in participacao.head(3).items():
+            linhas.append(f"  - {nome}: {fracao:.1%} (R$ {gastos_fornecedor[nome]:,.2f})")
+        if top3 > 0.5:
+            linhas.append("- ⚠️ Dependência elevada de poucos fornecedores: avaliar alternativas e renegociação")
+
+    # 4. Emissões de CO₂
+    if co2_summary and co2_summary.get('monthly_data'):
+        co2 = monthly_series(pd.Series({item['mes_ano']: item['co2_kg'] for item in co2_summary['monthly_data']}))
+        linhas.append("\n### 4. Emissões estimadas de CO₂")
+        linhas.append(f"- Total estimado: {co2_summary['total_kg']:,.2f} kg; pico em **{co2.idxmax()}** "
+                      f"({co2.max():,.2f} kg)")
+        if len(co2) >= 2 and co2.mean():
+            inclinacao = np.polyfit(np.arange(len(co2)), co2.values, 1)[0]
+            linhas.append(f"- Tendência: {inclinacao:+,.2f} kg CO₂ por mês ({inclinacao / co2.mean():+.1%} da média mensal)")
+
+        por_categoria = {}
+        for categorias in co2_summary.get('category_details', {}).values():
+            for categoria, valor in categorias.items():
+                por_categoria[categoria] = por_categoria.get(categoria, 0) + valor
+        total_co2 = sum(por_categoria.values())
+        if total_co2:
+            principais = sorted(por_categoria.items(), key=lambda kv: (-kv[1], kv[0]))[:3]
+            linhas.append("- Categorias com maior contribuição: " + ", ".join(
+                f"{categoria} ({valor / total_co2:.0%})" for categoria, valor in principais))
+
+    return "\n".join(linhas)
+
+def perform_autonomous_analysis(df, output_dir=None, prazo=None, on_narrative=None, itens=None):
+    """Executa análise autônoma completa.
+
+    `itens` é a tabela de decode_items(df), quando quem chama já a tem.
+
+    `prazo` (time.monotonic) limita a espera pelo LLM: se estourar, a análise
+    sai com o relatório local e a narrativa do LLM é entregue depois, em outra
+    thread, via `on_narrative(full_analysis)` (ou `on_narrative(None)` se falhar).
+    Devolve (full_analysis, plots, analysis_results).
+    """
     try:
         print("\n" + "="*60)
         print("INICIANDO ANÁLISE AUTÔNOMA")
         print("="*60)
         
-        # ANÁLISE PRÉVIA COM GEMINI
-        print("\n🔍 Analisando estrutura dos dados com Gemini...")
-        analyze_data_structure_with_gemini(df)
+        # Inferência local de esquema (cacheada por impressão digital)
+        print("\n🔍 Inferindo esquema e formatos de data...")
+        schema = infer_schema(df)
         
         # Criar cópia para não modificar o original
         df_work = df.copy()
@@ -422,18 +1264,9 @@ def perform_autonomous_analysis(df):
         print("\n📅 Processando datas...")
         print(f"Amostra de datas originais: {df_work['data_emissao'].head(3).tolist()}")
         
-        # CONVERSÃO ROBUSTA DE DATAS COM MÚLTIPLAS TENTATIVAS
-        # Formato: 2021-09-14T08:26:00-03:00 (ISO 8601 com timezone)
+        # CONVERSÃO DE DATAS COM FORMATO EXPLÍCITO (detectado pela inferência de esquema)
         df_work['data_emissao_original'] = df_work['data_emissao']
-        
-        # Tentativa 1: Conversão direta
-        df_work['data_emissao_dt'] = pd.to_datetime(df_work['data_emissao'], errors='coerce', utc=True)
-        
-        # Tentativa 2: Remover timezone manualmente se necessário
-        if df_work['data_emissao_dt'].isna().all():
-            print("⚠️ Conversão direta falhou, tentando remover timezone...")
-            df_work['data_emissao_clean'] = df_work['data_emissao'].astype(str).str.slice(0, 19)
-            df_work['data_emissao_dt'] = pd.to_datetime(df_work['data_emissao_clean'], errors='coerce')
+        df_work['data_emissao_dt'] = parse_emission_dates(df_work['data_emissao'], schema)
         
         # Filtrar apenas registros com datas válidas
         df_com_data = df_work[df_work['data_emissao_dt'].notna()].copy()
@@ -452,7 +1285,7 @@ DIAGNÓSTICO:
 SOLUÇÃO:
 - Revise o processo de extração dos XMLs
 - Garanta que as datas sejam extraídas corretamente"""
-            return error_msg, [None, None, None]
+            return error_msg, [None, None, None], {}
         
         data_inicio = df_com_data['data_emissao_dt'].min()
         data_fim = df_com_data['data_emissao_dt'].max()
@@ -478,16 +1311,18 @@ SOLUÇÃO:
         monthly_display['Média (R$)'] = monthly_display['Média (R$)'].apply(lambda x: f'R$ {x:,.2f}')
         
         fornecedores = df_work['emitente_nome'].nunique()
-        top_fornecedores = df_com_data.groupby('emitente_nome')['valor_nf'].sum().nlargest(5)
+        gastos_fornecedor = df_com_data.groupby('emitente_nome')['valor_nf'].sum().sort_values(ascending=False)
+        top_fornecedores = gastos_fornecedor.head(5)
         
-        # Análise de itens
-        total_itens = 0
-        for itens_str in df_work['itens'].dropna():
-            try:
-                itens = json.loads(itens_str)
-                total_itens += len(itens)
-            except:
-                continue
+        if 'tipo_documento' in df_work.columns:
+            tipos_documento = ', '.join(f"{tipo}: {qtd}" for tipo, qtd in df_work['tipo_documento'].value_counts().items())
+        else:
+            tipos_documento = 'NF-e'
+        
+        # Análise de itens (JSON decodificado uma vez; gráficos e CO2 reaproveitam)
+        if itens is None:
+            itens = decode_items(df_work)
+        total_itens = len(itens)
         
         data_summary = f"""
 ════════════════════════════════════════════════════════════
@@ -496,13 +1331,16 @@ RESUMO EXECUTIVO DO DATASET - NOTAS FISCAIS ELETRÔNICAS
 
 📊 INFORMAÇÕES GERAIS:
   • Total de Notas Fiscais: {total_nfs}
+  • Documentos por Tipo: {tipos_documento}
   • Valor Total Acumulado: R$ {total_valor:,.2f}
   • Período Analisado: {data_inicio.strftime('%d/%m/%Y')} a {data_fim.strftime('%d/%m/%Y')}
   • Número de Fornecedores Distintos: {fornecedores}
   • Total de Itens Comprados: {total_itens}
 
 📅 DISTRIBUIÇÃO TEMPORAL:
-  Formato Original: ISO 8601 com timezone (ex: 2021-09-14T08:26:00-03:00)
+  Versões de layout NF-e: {', '.join(schema['versoes_layout']) or 'não identificadas'}
+  Formatos de data detectados: {'; '.join(DATE_FORMATS[nome]['descricao'] for nome in schema['formatos_data']) or 'nenhum'}
+  Datas consideradas no horário local de emissão
   Colunas extraídas: ano, mês, mes_ano_str
   
   Distribuição Mensal de Gastos:
@@ -531,9 +1369,12 @@ RESUMO EXECUTIVO DO DATASET - NOTAS FISCAIS ELETRÔNICAS
         df_plot = df_com_data.copy()
         df_plot['mes_ano'] = df_plot['mes_ano_str']  # Usar string para compatibilidade
         
-        plot1 = generate_monthly_spending_chart(df_plot)
-        plot2 = generate_top_items_chart(df_work)
-        plot3, co2_summary = estimate_co2_emissions(df_plot)
+        # Séries agregadas (baratas); PNGs só no modo "png", os demais sob demanda
+        chart_series, co2_summary = build_chart_series(df_plot, df_work, itens)
+        if GRAFICOS_MODO == "png":
+            plot1, plot2, plot3 = render_chart_pngs(chart_frames(chart_series), output_dir)
+        else:
+            plot1 = plot2 = plot3 = None
         
         # Preparar resumo de CO2
         co2_text = ""
@@ -551,9 +1392,6 @@ RESUMO EXECUTIVO DO DATASET - NOTAS FISCAIS ELETRÔNICAS
 {chr(10).join([f"    • {cat.capitalize()}: {fator}" for cat, fator in co2_summary['emission_factors'].items()])}
 """
         
-        # Análise com Gemini
-        print("\n🤖 Consultando Gemini 2.5 Flash para análise completa...")
-        
         analysis_prompt = f"""Com base nos dados fornecidos, realize uma análise COMPLETA e DETALHADA respondendo:
 
 1. **ANÁLISE TEMPORAL E SAZONALIDADE:**
@@ -594,10 +1432,6 @@ RESUMO EXECUTIVO DO DATASET - NOTAS FISCAIS ELETRÔNICAS
 
 IMPORTANTE: Use os números específicos fornecidos. Seja OBJETIVO e DIRETO nas respostas."""
 
-        analysis_text = call_gemini_analysis(analysis_prompt, data_summary)
-        
-        print("✓ Análise Gemini concluída")
-        
         # Metodologia CO2
         methodology = """
 ═══════════════════════════════════════════════════════════════════════
@@ -653,12 +1487,13 @@ METODOLOGIA DE ESTIMATIVA DE EMISSÕES DE CO₂
 ═══════════════════════════════════════════════════════════════════════
 """
         
-        full_analysis = f"""# 📊 ANÁLISE AUTOMÁTICA - NOTAS FISCAIS ELETRÔNICAS
+        def compose_report(analysis_text, section_title):
+            return f"""# 📊 ANÁLISE AUTOMÁTICA - NOTAS FISCAIS ELETRÔNICAS
 ### Powered by Gemini 2.5 Flash
 
 {data_summary}
 
-## 🔍 ANÁLISE DETALHADA DA IA
+## {section_title}
 
 {analysis_text}
 
@@ -668,118 +1503,1129 @@ METODOLOGIA DE ESTIMATIVA DE EMISSÕES DE CO₂
 **💡 Dica:** Você pode fazer perguntas adicionais no chat interativo abaixo sobre qualquer aspecto desta análise.
 """
         
-        state.analysis_results = {
+        # Análise com Gemini, limitada pelo prazo; sem resposta a tempo, vale o relatório local
+        print("\n🤖 Consultando Gemini 2.5 Flash para análise completa...")
+        future = llm_executor.submit(generate_gemini_analysis, analysis_prompt, data_summary)
+        narrativa_pendente = False
+        try:
+            analysis_text = future.result(timeout=remaining_time(prazo))
+            full_analysis = compose_report(analysis_text, "🔍 ANÁLISE DETALHADA DA IA")
+            print("✓ Análise Gemini concluída")
+        except Exception as e:
+            local_report = build_local_report(monthly_stats, gastos_fornecedor, co2_summary)
+            if isinstance(e, FuturesTimeoutError) and on_narrative is not None:
+                print("⏱️ Gemini não respondeu no prazo; usando relatório local")
+                narrativa_pendente = True
+                aviso = ("⏱️ A IA não respondeu dentro do prazo. Este relatório foi calculado localmente "
+                         "e será substituído pela análise da IA assim que ela chegar.")
+
+                def deliver_narrative():
+                    try:
+                        texto = future.result()
+                    except Exception as erro:
+                        print(f"✗ Narrativa Gemini indisponível: {erro}")
+                        on_narrative(None)
+                        return
+                    on_narrative(compose_report(texto, "🔍 ANÁLISE DETALHADA DA IA"))
+
+                threading.Thread(target=deliver_narrative, daemon=True).start()
+            else:
+                print(f"⚠️ Análise Gemini indisponível ({e}); usando relatório local")
+                aviso = f"⚠️ Análise da IA indisponível ({e}). Este relatório foi calculado localmente."
+            full_analysis = compose_report(f"{aviso}\n\n{local_report}", "🧮 ANÁLISE DETALHADA (RELATÓRIO LOCAL)")
+        
+        analysis_results = {
             'full_analysis': full_analysis,
             'plots': [plot1, plot2, plot3],
-            'co2_summary': co2_summary
+            'chart_series': chart_series,
+            'co2_summary': co2_summary,
+            'narrativa_pendente': narrativa_pendente
         }
-        
-        # Atualizar o estado global com o DataFrame processado
-        state.df = df_com_data
-        
         print("\n✓✓✓ ANÁLISE COMPLETA FINALIZADA ✓✓✓\n")
         
-        return full_analysis, [plot1, plot2, plot3]
+        return full_analysis, [plot1, plot2, plot3], analysis_results
         
     except Exception as e:
         error_msg = f"❌ Erro na análise autônoma: {str(e)}"
         print(error_msg)
         import traceback
         traceback.print_exc()
-        return error_msg, [None, None, None]
+        return error_msg, [None, None, None], {}
 
 # ===========================================================
 # PROCESSAMENTO PRINCIPAL
 # ===========================================================
-def process_archive(uploaded_file):
+def parse_xml_files(xml_files):
+    """Converte a lista de XMLs em um DataFrame de documentos fiscais, em uma única passada.
+
+    Devolve (df, contagem): df é None se nenhum documento for válido; contagem
+    traz o número de arquivos por tipo. Cancelamentos registrados removem o
+    documento cancelado e duplicatas (ex.: NFe avulsa + nfeProc) são unificadas.
+    """
+    documentos = []
+    cancelados = set()
+    contagem = {"nfe": 0, "nfce": 0, "cte": 0, "cancelamento": 0, "evento": 0, "erro": 0}
+    for xml_file in xml_files:
+        try:
+            tipo, data = parse_document(xml_file)
+        except Exception as e:
+            print(f"Erro em {xml_file}: {e}")
+            contagem["erro"] += 1
+            continue
+
+        contagem[tipo] += 1
+        if tipo == "cancelamento":
+            if data["chave"]:
+                cancelados.add(data["chave"])
+        elif tipo != "evento":
+            documentos.append(data)
+
+    contagem["duplicados"] = 0
+    contagem["cancelados_aplicados"] = 0
+    if not documentos:
+        return None, contagem
+
+    df = pd.DataFrame(documentos)
+    df["valor_nf"] = pd.to_numeric(df["valor_nf"], errors="coerce")
+
+    # Chave de acesso: os 44 dígitos do Id ("NFe3521..." / "CTe3521...")
+    chave_acesso = df["chave"].str[-44:]
+    com_chave = chave_acesso.str.len() == 44
+
+    # Entre cópias do mesmo documento, fica a que tem protocolo de autorização
+    sem_protocolo = df["protocolo"].isna() if "protocolo" in df.columns else pd.Series(True, index=df.index)
+    ordem = sem_protocolo.sort_values(kind="stable").index
+    duplicado = chave_acesso[ordem].duplicated() & com_chave[ordem]
+    duplicado = duplicado.reindex(df.index)
+    cancelado = chave_acesso.isin(cancelados) & ~duplicado
+
+    contagem["duplicados"] = int(duplicado.sum())
+    contagem["cancelados_aplicados"] = int(cancelado.sum())
+    df = df[~(duplicado | cancelado)].reset_index(drop=True)
+    if df.empty:
+        return None, contagem
+    return df, contagem
+
+def format_document_counts(contagem):
+    if not contagem:
+        return ""
+    return (f"📑 Documentos lidos: {contagem['nfe']} NF-e, {contagem['nfce']} NFC-e, {contagem['cte']} CT-e, "
+            f"{contagem['cancelamento']} cancelamento(s), {contagem['evento']} outro(s) evento(s), "
+            f"{contagem['erro']} inválido(s) — {contagem['cancelados_aplicados']} documento(s) cancelado(s) "
+            f"e {contagem['duplicados']} duplicado(s) removido(s) dos totais")
+
+def load_parsed_table(csv_path, nrows=None):
+    """Lê o CSV unificado com os tipos inferidos: colunas numéricas viram números e
+    códigos (CNPJ, NCM, chave) continuam texto"""
+    df = pd.read_csv(csv_path, sep=";", encoding="utf-8", dtype=str, nrows=nrows)
+    for coluna, tipo in infer_schema(df)["tipos_colunas"].items():
+        if tipo == "numerico":
+            df[coluna] = pd.to_numeric(df[coluna], errors="coerce")
+    # A análise soma valor_nf mesmo quando a amostra não o reconhece como numérico
+    df["valor_nf"] = pd.to_numeric(df["valor_nf"], errors="coerce")
+    return df
+
+def save_atomic(path, write_fn):
+    """Grava via arquivo temporário + os.replace: o arquivo final só existe completo"""
+    tmp_path = path + ".tmp"
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+# ===========================================================
+# EXPLORADOR DE DADOS (SQLITE INDEXADO NO SERVIDOR)
+# ===========================================================
+EXPLORADOR_TAMANHO_PAGINA = 50
+# Até este total, a página sai do índice do filtro mais seletivo com ordenação
+# em memória; acima, do índice da ordenação (as linhas filtradas são densas)
+EXPLORADOR_LIMIAR_ORDENACAO = 20_000
+
+# (coluna, tipo SQLite) exibidas pelo explorador. Os dados da nota ficam numa
+# tabela `notas` (uma linha por nota) e não se repetem em cada item
+NOTA_COLUMNS = [
+    ("chave", "TEXT"),
+    ("numero", "TEXT"),
+    ("data_emissao", "TEXT"),
+    ("emitente_cnpj", "TEXT"),
+    ("emitente_nome", "TEXT"),
+]
+ITEM_COLUMNS = [
+    ("item", "TEXT"),
+    ("codigo", "TEXT"),
+    ("descricao", "TEXT"),
+    ("ncm", "TEXT"),
+    ("cfop", "TEXT"),
+    ("unidade", "TEXT"),
+    ("quantidade", "REAL"),
+    ("valor_unitario", "REAL"),
+    ("valor_total", "REAL"),
+]
+
+# Filtros e ordenações consultam colunas inteiras (índices pequenos e rápidos):
+# mês AAAAMM, CNPJ, NCM de 8 dígitos (prefixo vira intervalo) e CFOP. Cada
+# ordenação tem a chave `ordem_<coluna>`, sem nulos, com o id como desempate
+ITEM_FILTER_COLUMNS = ["mes", "cnpj", "ncm_codigo", "cfop_codigo"]
+ITEM_SORT_COLUMNS = ["data_emissao", "valor_total", "descricao"]
+ITEM_SORT_KEYS = [f"ordem_{ordem}" for ordem in ITEM_SORT_COLUMNS]
+
+# Índices cobrem todos os filtros, então combinações de filtros são avaliadas
+# dentro do índice, sem ler a tabela:
+#   - um por ordenação: (chave, id, filtros) percorre já na ordem pedida;
+#   - um por filtro: (filtro, demais filtros) conta e localiza resultados pequenos
+ITEM_INDEXES = {
+    **{chave: [chave, "id"] + ITEM_FILTER_COLUMNS for chave in ITEM_SORT_KEYS},
+    **{filtro: [filtro] + [f for f in ITEM_FILTER_COLUMNS if f != filtro] for filtro in ITEM_FILTER_COLUMNS},
+}
+
+def sql_values(valores, validos=None):
+    """Array numpy -> objetos Python aceitos pelo sqlite3 (None onde inválido)"""
+    saida = valores.astype(object)
+    if validos is not None:
+        saida[~validos] = None
+    return saida
+
+def digit_codes(series, tamanho=None):
+    """Códigos só com dígitos (de `tamanho` fixo, se dado) como inteiros; (valores, válidos)"""
+    texto = series.astype(object).where(series.notna(), "").astype(str).str.strip()
+    validos = texto.str.fullmatch(r"\d{%d}" % tamanho if tamanho else r"\d{1,18}").to_numpy()
+    valores = np.zeros(len(texto), dtype=np.int64)
+    valores[validos] = texto[validos].astype(np.int64).to_numpy()
+    return valores, validos
+
+def item_table(df, itens):
+    """Colunas das tabelas `notas` e `itens` (exibição, filtros e chaves de ordenação) como arrays"""
+    nota = itens["nota"].to_numpy()
+    notas = df[[nome for nome, _ in NOTA_COLUMNS]]
+    notas = notas.astype(object).where(notas.notna(), None)
+    colunas_notas = {"nota": sql_values(np.arange(len(df), dtype=np.int64))}
+    colunas_notas.update({nome: notas[nome].to_numpy() for nome in notas.columns})
+
+    colunas = {"id": sql_values(np.arange(len(itens), dtype=np.int64)), "nota": sql_values(nota)}
+    campos = itens[list(ITEM_CAMPOS_TEXTO + ITEM_CAMPOS_NUMERICOS)]
+    campos = campos.astype(object).where(campos.notna(), None)
+    for nome in campos.columns:
+        colunas[nome] = campos[nome].to_numpy()
+
+    # Mês local da emissão pelo mesmo parser da análise: vale para qualquer formato de data aceito
+    datas = parse_emission_dates(df["data_emissao"], infer_schema(df))
+    com_data = datas.notna().to_numpy()
+    colunas["mes"] = sql_values((datas.dt.year * 100 + datas.dt.month).fillna(0).to_numpy(np.int64), com_data)[nota]
+    cnpj, com_cnpj = digit_codes(df["emitente_cnpj"])
+    colunas["cnpj"] = sql_values(cnpj, com_cnpj)[nota]
+    colunas["ncm_codigo"] = sql_values(*digit_codes(itens["ncm"], 8))
+    colunas["cfop_codigo"] = sql_values(*digit_codes(itens["cfop"], 4))
+
+    # Chaves de ordenação sem nulos (nulos primeiro na ordem crescente)
+    segundos = np.where(com_data, datas.to_numpy().astype("datetime64[s]").astype(np.int64), np.iinfo(np.int64).min)
+    colunas["ordem_data_emissao"] = sql_values(segundos[nota])
+    colunas["ordem_valor_total"] = sql_values(np.nan_to_num(itens["valor_total"].to_numpy(), nan=-np.inf))
+    # Descrição vira a posição na ordem alfabética (ordem de bytes UTF-8, como no SQLite)
+    desc_codigos, distintas = pd.factorize(itens["descricao"].to_numpy(dtype=object))
+    posicao = np.empty(len(distintas) + 1, dtype=np.int64)
+    posicao[np.argsort(np.array([str(desc) for desc in distintas], dtype=object), kind="stable")] = np.arange(len(distintas))
+    posicao[-1] = -1
+    colunas["ordem_descricao"] = sql_values(posicao[desc_codigos])
+    return colunas_notas, colunas
+
+def build_items_db(df, db_path, itens=None):
+    """Cria o banco SQLite indexado com os itens das notas (uma vez por job)"""
+    if itens is None:
+        itens = decode_items(df)
+
+    def write(tmp_path):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        colunas_notas, colunas = item_table(df, itens)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            # Banco descartável e reconstruível: sem journal nem fsync durante a carga
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            definicoes = ["nota INTEGER PRIMARY KEY"] + [f"{nome} {tipo}" for nome, tipo in NOTA_COLUMNS]
+            conn.execute(f"CREATE TABLE notas ({', '.join(definicoes)})")
+            conn.executemany(f"INSERT INTO notas VALUES ({', '.join('?' for _ in definicoes)})",
+                             zip(*colunas_notas.values()))
+
+            definicoes = (["id INTEGER PRIMARY KEY", "nota INTEGER"] + [f"{nome} {tipo}" for nome, tipo in ITEM_COLUMNS]
+                          + [f"{nome} INTEGER" for nome in ITEM_FILTER_COLUMNS]
+                          + ["ordem_data_emissao INTEGER NOT NULL", "ordem_valor_total REAL NOT NULL",
+                             "ordem_descricao INTEGER NOT NULL"])
+            conn.execute(f"CREATE TABLE itens ({', '.join(definicoes)})")
+            nomes = [definicao.split()[0] for definicao in definicoes]
+            conn.executemany(f"INSERT INTO itens VALUES ({', '.join('?' for _ in nomes)})",
+                             zip(*(colunas[nome] for nome in nomes)))
+            for nome, indice in ITEM_INDEXES.items():
+                conn.execute(f"CREATE INDEX idx_itens_{nome} ON itens ({', '.join(indice)})")
+
+            # Contagens por valor de cada filtro: total de um filtro só sem varrer
+            # índice, e estimativa para escolher o filtro mais seletivo
+            conn.execute("CREATE TABLE contagens (filtro TEXT, valor INTEGER, n INTEGER, "
+                         "PRIMARY KEY (filtro, valor)) WITHOUT ROWID")
+            conn.execute("INSERT INTO contagens VALUES ('*', 0, ?)", (len(itens),))
+            for filtro in ITEM_FILTER_COLUMNS:
+                contagem = pd.Series(colunas[filtro]).dropna().value_counts()
+                conn.executemany("INSERT INTO contagens VALUES (?, ?, ?)",
+                                 ((filtro, int(valor), int(n)) for valor, n in contagem.items()))
+            conn.commit()
+        finally:
+            conn.close()
+
     start_time = time.time()
-    temp_dir = tempfile.mkdtemp()
-    
+    save_atomic(db_path, write)
+    print(f"✓ Itens indexados em SQLite ({time.time() - start_time:.1f}s): {db_path}")
+
+def item_filters(mes=None, cnpj=None, ncm=None, cfop=None):
+    """Filtros do explorador como [(coluna, primeiro, último)] sobre os códigos inteiros"""
+    def digitos(texto):
+        return "".join(c for c in (texto or "") if c.isdigit())
+
+    filtros = []
+    if digitos(mes):
+        filtros.append(("mes", int(digitos(mes)), int(digitos(mes))))
+    if digitos(cnpj):
+        filtros.append(("cnpj", int(digitos(cnpj)), int(digitos(cnpj))))
+    prefixo = digitos(ncm)[:8]
+    if prefixo:
+        # Prefixo de NCM (capítulo, posição...): intervalo de códigos de 8 dígitos
+        escala = 10 ** (8 - len(prefixo))
+        filtros.append(("ncm_codigo", int(prefixo) * escala, (int(prefixo) + 1) * escala - 1))
+    if digitos(cfop):
+        filtros.append(("cfop_codigo", int(digitos(cfop)), int(digitos(cfop))))
+    return filtros
+
+def query_items(db_path, mes=None, cnpj=None, ncm=None, cfop=None,
+                ordenar_por="data_emissao", descendente=True,
+                pagina=1, tamanho_pagina=EXPLORADOR_TAMANHO_PAGINA, cursor=None):
+    """Devolve (página como DataFrame, total de itens filtrados, página efetiva, cursor).
+
+    O cursor guarda a chave da primeira e da última linha da página: a página
+    vizinha da mesma consulta é lida a partir dele (keyset), sem OFFSET.
+    """
+    if ordenar_por not in ITEM_SORT_COLUMNS:
+        raise ValueError(f"Coluna de ordenação inválida: {ordenar_por}")
+    chave = f"ordem_{ordenar_por}"
+    filtros = item_filters(mes, cnpj, ncm, cfop)
+    where = [f"{coluna} BETWEEN ? AND ?" for coluna, _, _ in filtros]
+    params = [valor for _, primeiro, ultimo in filtros for valor in (primeiro, ultimo)]
+    consulta = [mes, cnpj, ncm, cfop, ordenar_por, bool(descendente)]
+
+    conn = sqlite3.connect(f"{Path(db_path).as_uri()}?mode=ro", uri=True)
     try:
-        # Extrair arquivo
-        file_path = uploaded_file.name if hasattr(uploaded_file, 'name') else uploaded_file
-        extract_archive(file_path, temp_dir)
-        
-        # Encontrar XMLs
-        xml_files = list(Path(temp_dir).rglob("*.xml"))
-        
-        if not xml_files:
-            yield "❌ Nenhum arquivo XML encontrado no arquivo compactado.", None, None, None, None, None, gr.update(interactive=False)
-            return
-        
-        yield f"📦 Processando {len(xml_files)} arquivos XML...", None, None, None, None, None, gr.update(interactive=False)
-        
-        # Parse XMLs
-        nfe_data = []
-        for xml_file in xml_files:
+        # Filtro mais seletivo pelas contagens pré-calculadas
+        estimativas = {
+            coluna: conn.execute("SELECT COALESCE(SUM(n), 0) FROM contagens "
+                                 "WHERE filtro = ? AND valor BETWEEN ? AND ?", (coluna, primeiro, ultimo)).fetchone()[0]
+            for coluna, primeiro, ultimo in filtros
+        }
+        if not filtros:
+            total = conn.execute("SELECT n FROM contagens WHERE filtro = '*'").fetchone()[0]
+        elif len(filtros) == 1:
+            total = estimativas[filtros[0][0]]
+        else:
+            guia = min(estimativas, key=estimativas.get)
+            total = conn.execute(f"SELECT COUNT(*) FROM itens INDEXED BY idx_itens_{guia} "
+                                 f"WHERE {' AND '.join(where)}", params).fetchone()[0]
+
+        total_paginas = max(1, -(-total // tamanho_pagina))
+        pagina = min(max(1, int(pagina)), total_paginas)
+
+        # Resultado pequeno: índice do filtro + ordenação em memória; grande: índice da ordenação
+        if filtros and total <= EXPLORADOR_LIMIAR_ORDENACAO:
+            indice = f"idx_itens_{min(estimativas, key=estimativas.get)}"
+        else:
+            indice = f"idx_itens_{chave}"
+
+        # Página vizinha da anterior: continua da chave da borda (keyset); demais, OFFSET
+        condicoes, valores, offset, inverter = list(where), list(params), (pagina - 1) * tamanho_pagina, False
+        if cursor and cursor.get("consulta") == consulta and abs(pagina - cursor["pagina"]) == 1:
+            inverter = pagina < cursor["pagina"]
+            borda = cursor["primeiro"] if inverter else cursor["ultimo"]
+            condicoes.append(f"({chave}, id) {'>' if descendente == inverter else '<'} (?, ?)")
+            valores += borda
+            offset = 0
+        direcao = "DESC" if descendente != inverter else "ASC"
+        sql_where = f" WHERE {' AND '.join(condicoes)}" if condicoes else ""
+        linhas = conn.execute(
+            f"SELECT id, {chave} FROM itens INDEXED BY {indice}{sql_where} "
+            f"ORDER BY {chave} {direcao}, id {direcao} LIMIT ? OFFSET ?",
+            valores + [tamanho_pagina, offset],
+        ).fetchall()
+        if inverter:
+            linhas.reverse()
+
+        # Só as linhas da página são lidas das tabelas
+        ids = [id_ for id_, _ in linhas]
+        colunas = ", ".join([f"notas.{nome}" for nome, _ in NOTA_COLUMNS] + [f"itens.{nome}" for nome, _ in ITEM_COLUMNS])
+        page_df = pd.read_sql_query(
+            f"SELECT itens.id, {colunas} FROM itens JOIN notas ON notas.nota = itens.nota "
+            f"WHERE itens.id IN ({', '.join('?' for _ in ids)})", conn, params=ids,
+        ).set_index("id").reindex(ids).reset_index(drop=True)
+    finally:
+        conn.close()
+
+    # Bordas como (chave, id), a ordem da comparação de keyset
+    cursor = {"consulta": consulta, "pagina": pagina,
+              "primeiro": [linhas[0][1], linhas[0][0]], "ultimo": [linhas[-1][1], linhas[-1][0]]} if linhas else None
+    return page_df, total, pagina, cursor
+
+def list_item_months(db_path):
+    conn = sqlite3.connect(f"{Path(db_path).as_uri()}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT valor FROM contagens WHERE filtro = 'mes' ORDER BY valor").fetchall()
+    finally:
+        conn.close()
+    return [f"{mes // 100:04d}-{mes % 100:02d}" for (mes,) in rows]
+
+def browse_items(job_id, mes, cnpj, ncm, cfop, ordenar_por, ordem, pagina, cursor=None):
+    """Handler do explorador: consulta só a página visível no servidor.
+
+    `cursor` (gr.State) é o da última página exibida; com ele, Anterior/Próxima
+    seguem por keyset em vez de OFFSET.
+    """
+    job_id = (job_id or "").strip()
+    # Só IDs registrados viram caminho em disco
+    job = job_manager.obter(job_id) if job_id else None
+    if job is None:
+        return None, "⚠️ Job não encontrado ou expirado. Processe um arquivo primeiro.", 1, gr.update(), None
+    if job.get("indexacao") == "executando":
+        return None, "⏳ Os itens ainda estão sendo indexados. Tente novamente em instantes.", 1, gr.update(), None
+    db_path = os.path.join(job_manager.job_dir(job_id), "itens.sqlite")
+    if not os.path.exists(db_path):
+        return None, "⚠️ Nenhum dado indexado para este job. Processe um arquivo primeiro.", 1, gr.update(), None
+    job_manager.artifacts.touch(job_id)
+
+    try:
+        start_time = time.time()
+        page_df, total, pagina, cursor = query_items(
+            db_path, mes=mes, cnpj=cnpj, ncm=ncm, cfop=cfop,
+            ordenar_por=ordenar_por, descendente=(ordem == "Decrescente"),
+            pagina=pagina or 1, cursor=cursor,
+        )
+        elapsed_ms = (time.time() - start_time) * 1000
+    except Exception as e:
+        return None, f"❌ Erro na consulta: {str(e)}", 1, gr.update(), None
+
+    total_paginas = max(1, -(-total // EXPLORADOR_TAMANHO_PAGINA))
+    info = f"📄 Página {pagina} de {total_paginas} — {total:,} itens encontrados ({elapsed_ms:.0f} ms)"
+    meses = gr.update(choices=[""] + list_item_months(db_path))
+    return page_df, info, pagina, meses, cursor
+
+# ===========================================================
+# GERENCIAMENTO DE ARTEFATOS (WORKSPACES EM DISCO)
+# ===========================================================
+# Configuração via variáveis de ambiente
+ARTIFACTS_MAX_MB = int(os.environ.get("IGUACU_ARTIFACTS_MAX_MB", "2048"))
+# Carência após o último uso: workspaces mais recentes nunca são descartados pelo limite
+ARTIFACTS_CARENCIA_S = float(os.environ.get("IGUACU_ARTIFACTS_CARENCIA_S", "900"))
+# Limpeza do cache do próprio Gradio (uploads e arquivos servidos): (frequência, idade) em segundos
+GRADIO_CACHE_LIMPEZA = (3600, 24 * 3600)
+
+class ArtifactManager:
+    """Workspaces por job em disco, com limpeza por etapa e política LRU limitada por tamanho.
+
+    O "último uso" de um workspace é o mtime do diretório, renovado a cada
+    acesso (touch), então a ordem LRU sobrevive a reinícios do servidor.
+    Workspaces usados há menos de `carencia_s` segundos não são descartados.
+    """
+    def __init__(self, base_dir, max_bytes, carencia_s):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self.carencia_s = carencia_s
+        # Uma aplicação do limite por vez: duas varreduras simultâneas removeriam em dobro
+        self.lock = threading.Lock()
+        os.makedirs(base_dir, exist_ok=True)
+
+    def workspace(self, job_id):
+        return os.path.join(self.base_dir, job_id)
+
+    def create_workspace(self, job_id):
+        path = self.workspace(job_id)
+        os.makedirs(path)
+        return path
+
+    def touch(self, job_id):
+        try:
+            os.utime(self.workspace(job_id))
+        except FileNotFoundError:
+            pass
+
+    def release_inputs(self, job_id):
+        """Remove arquivo enviado e XMLs extraídos, que só são necessários até o parse"""
+        path = Path(self.workspace(job_id))
+        shutil.rmtree(path / "xml", ignore_errors=True)
+        for entrada in path.glob("entrada.*"):
+            entrada.unlink(missing_ok=True)
+        (path / "extracao.ok").unlink(missing_ok=True)
+
+    def workspace_size(self, path):
+        """Tamanho em bytes; arquivos removidos durante a varredura (outro worker) contam 0"""
+        total = 0
+        for raiz, _, arquivos in os.walk(path):
+            for nome in arquivos:
+                try:
+                    total += os.stat(os.path.join(raiz, nome)).st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def last_use(self, path):
+        try:
+            return path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def enforce_limit(self, candidatos):
+        """Remove os workspaces menos usados entre os candidatos até caber no limite.
+
+        Devolve os IDs removidos. Workspaces fora de `candidatos` (jobs em
+        andamento ou acompanhados) ou ainda na carência contam no total mas
+        nunca são removidos; se só eles já estouram o limite, isso é avisado.
+        """
+        with self.lock:
+            # Workspaces que somem no meio da varredura ficam de fora
+            usos = {p: self.last_use(p) for p in Path(self.base_dir).iterdir() if p.is_dir()}
+            usos = {p: uso for p, uso in usos.items() if uso is not None}
+            sizes = {p.name: self.workspace_size(p) for p in usos}
+            total = sum(sizes.values())
+            limite_carencia = time.time() - self.carencia_s
+
+            removidos = []
+            for path in sorted(usos, key=usos.get):
+                if total <= self.max_bytes:
+                    break
+                if path.name not in candidatos or usos[path] > limite_carencia:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= sizes[path.name]
+                removidos.append(path.name)
+
+        if removidos:
+            print(f"🧹 {len(removidos)} workspace(s) removido(s) pelo limite de disco "
+                  f"({total / 1024**2:.0f} MB em uso de {self.max_bytes / 1024**2:.0f} MB)")
+        if total > self.max_bytes:
+            print(f"⚠️ Limite de disco excedido: {total / 1024**2:.0f} MB em uso de "
+                  f"{self.max_bytes / 1024**2:.0f} MB, só em workspaces protegidos (em uso ou recentes)")
+        return removidos
+
+    def cleanup_startup(self):
+        """Remove restos de execuções interrompidas antes de retomar os jobs"""
+        for path in Path(self.base_dir).iterdir():
+            if not path.is_dir():
+                continue
+
+            # Queda durante a criação do job: não há estado para retomar
+            if not (path / "job.json").exists():
+                shutil.rmtree(path, ignore_errors=True)
+                print(f"🧹 Workspace órfão removido: {path.name}")
+                continue
+
+            # A limpeza não deve contar como uso para a política LRU
+            mtime = path.stat().st_mtime
+            for tmp in path.glob("*.tmp"):
+                tmp.unlink(missing_ok=True)
+            if (path / "notas_fiscais.csv").exists():
+                self.release_inputs(path.name)
+            os.utime(path, (mtime, mtime))
+
+# ===========================================================
+# FILA DE JOBS (PROCESSAMENTO EM SEGUNDO PLANO)
+# ===========================================================
+# Configuração via variáveis de ambiente
+JOBS_DIR = os.environ.get("IGUACU_JOBS_DIR", os.path.join(tempfile.gettempdir(), "iguacu_jobs"))
+JOB_MAX_WORKERS = int(os.environ.get("IGUACU_JOB_MAX_WORKERS", "2"))
+JOB_MAX_POR_USUARIO = int(os.environ.get("IGUACU_JOB_MAX_POR_USUARIO", "1"))
+JOB_POLL_INTERVAL = 1.0
+
+JOB_STATUS_FINAIS = ("concluido", "erro")
+
+class JobManager:
+    """Fila local de jobs: pool de workers, limites de concorrência e estado em disco.
+
+    Cada job vive em um workspace do ArtifactManager (JOBS_DIR/<id>/) com:
+      - job.json            estado e mensagem de progresso
+      - entrada.<ext>       cópia do arquivo enviado (removida após o parse)
+      - xml/ + extracao.ok  XMLs extraídos (etapa 1, removidos após o parse)
+      - notas_fiscais.csv   tabela unificada (etapa 2)
+      - resultado.json      análise e gráficos (etapa 3)
+      - itens.sqlite        itens indexados para o explorador (etapa 4, após publicar o resultado)
+    A existência do artefato de uma etapa permite retomar o job a partir dela.
+    """
+    def __init__(self, artifacts, max_workers, max_por_usuario):
+        self.artifacts = artifacts
+        self.max_workers = max_workers
+        self.max_por_usuario = max_por_usuario
+        self.jobs = {}
+        self.fila = []
+        self.ativos_por_usuario = {}
+        self.seguidores = {}
+        self.cond = threading.Condition()
+        self.workers = []
+        self.iniciado = False
+        self.inicio_lock = threading.Lock()
+
+    def job_dir(self, job_id):
+        return self.artifacts.workspace(job_id)
+
+    def iniciar(self):
+        """Limpa e recupera JOBS_DIR e sobe os workers (uma vez; chamado no primeiro uso)"""
+        with self.inicio_lock:
+            if self.iniciado:
+                return
+            self.iniciado = True
+            self.artifacts.cleanup_startup()
+            with self.cond:
+                self._recuperar_jobs()
+            self._aplicar_limite_disco()
+            for i in range(self.max_workers):
+                worker = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            print(f"✓ Fila de jobs iniciada: {self.max_workers} workers, "
+                  f"{self.max_por_usuario} job(s) simultâneo(s) por usuário")
+
+    def _salvar(self, job):
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job, f, ensure_ascii=False, indent=2)
+        save_atomic(os.path.join(self.job_dir(job["id"]), "job.json"), write)
+
+    def _recuperar_jobs(self):
+        """Recarrega jobs do disco e recoloca na fila os que não terminaram"""
+        for job_json in sorted(Path(self.artifacts.base_dir).glob("*/job.json")):
             try:
-                data = parse_nfe(xml_file)
-                nfe_data.append(data)
+                with open(job_json, encoding="utf-8") as f:
+                    job = json.load(f)
             except Exception as e:
-                print(f"Erro em {xml_file}: {e}")
+                print(f"✗ Job ilegível em {job_json}: {e}")
                 continue
-        
-        if not nfe_data:
-            yield "❌ Não foi possível processar nenhum XML válido.", None, None, None, None, None, gr.update(interactive=False)
+
+            self.jobs[job["id"]] = job
+            if job.get("narrativa_pendente"):
+                # A chamada ao LLM que traria a narrativa morreu com o processo
+                job["narrativa_pendente"] = False
+                job["mensagem"] += "\n\n⚠️ A análise da IA não ficou disponível; o relatório local é o definitivo."
+                job["versao"] += 1
+                self._salvar(job)
+            # Indexação interrompida: o job volta à fila e retoma direto na etapa 4
+            if job["status"] not in JOB_STATUS_FINAIS or job.get("indexacao") == "executando":
+                job["status"] = "na_fila"
+                job["mensagem"] = "♻️ Job retomado após reinício do servidor..."
+                job["versao"] += 1
+                self._salvar(job)
+                self.fila.append(job["id"])
+                print(f"♻️ Job {job['id']} retomado (última etapa: {job.get('etapa')})")
+
+    def submeter(self, arquivo, usuario):
+        """Registra um novo job e devolve seu ID"""
+        self.iniciar()
+        job_id = uuid.uuid4().hex[:12]
+        job_dir = self.artifacts.create_workspace(job_id)
+
+        # Copiar entrada: o arquivo temporário do Gradio pode sumir antes do job rodar
+        entrada = os.path.join(job_dir, "entrada" + Path(arquivo).suffix.lower())
+        shutil.copy(arquivo, entrada)
+
+        job = {
+            "id": job_id,
+            "usuario": usuario,
+            "arquivo": entrada,
+            "status": "na_fila",
+            "etapa": None,
+            "mensagem": "⏳ Job na fila, aguardando um worker livre...",
+            "csv_path": None,
+            "plots": [None, None, None],
+            "criado_em": time.time(),
+            "versao": 0,
+        }
+        with self.cond:
+            self.jobs[job_id] = job
+            self._salvar(job)
+            self.fila.append(job_id)
+            self.cond.notify_all()
+
+        print(f"✓ Job {job_id} criado para '{usuario}'")
+        return job_id
+
+    def atualizar(self, job_id, **campos):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                # Job expirado (workspace descartado): não há mais o que atualizar
+                return
+            job.update(campos)
+            job["versao"] += 1
+            self._salvar(job)
+            self.cond.notify_all()
+
+    def obter(self, job_id):
+        self.iniciar()
+        with self.cond:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def aguardar_mudanca(self, job_id, versao, timeout):
+        """Bloqueia até o job mudar de versão (ou até o timeout) e devolve o estado atual.
+
+        Devolve None se o job expirou nesse meio-tempo.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: job_id not in self.jobs or self.jobs[job_id]["versao"] != versao, timeout)
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def seguir(self, job_id):
+        """Registra um cliente acompanhando o job (protege o workspace do descarte)"""
+        with self.cond:
+            self.seguidores[job_id] = self.seguidores.get(job_id, 0) + 1
+
+    def deixar(self, job_id):
+        with self.cond:
+            restantes = self.seguidores.get(job_id, 0) - 1
+            if restantes > 0:
+                self.seguidores[job_id] = restantes
+            else:
+                self.seguidores.pop(job_id, None)
+
+    def _proximo_job(self):
+        """Primeiro job da fila cujo usuário está abaixo do limite (chamar com o lock)"""
+        for job_id in self.fila:
+            usuario = self.jobs[job_id]["usuario"]
+            if self.ativos_por_usuario.get(usuario, 0) < self.max_por_usuario:
+                self.fila.remove(job_id)
+                self.ativos_por_usuario[usuario] = self.ativos_por_usuario.get(usuario, 0) + 1
+                return job_id
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self.cond:
+                job_id = self._proximo_job()
+                while job_id is None:
+                    self.cond.wait()
+                    job_id = self._proximo_job()
+                usuario = self.jobs[job_id]["usuario"]
+
+            try:
+                run_job(self, job_id)
+            except Exception as e:
+                print(f"✗ Job {job_id} falhou: {e}")
+                traceback.print_exc()
+                self.atualizar(job_id, status="erro", etapa=None, mensagem=f"❌ Erro: {str(e)}")
+            finally:
+                with self.cond:
+                    self.ativos_por_usuario[usuario] -= 1
+                    job = self.jobs.get(job_id)
+                    status = job["status"] if job else None
+                    self.cond.notify_all()
+                if status == "erro":
+                    self.artifacts.release_inputs(job_id)
+                # Conclusão conta como uso: a carência protege o resultado recém-publicado
+                self.artifacts.touch(job_id)
+                # Falha na limpeza não pode derrubar o worker (a fila pararia)
+                try:
+                    self._aplicar_limite_disco()
+                except Exception as e:
+                    print(f"✗ Falha ao aplicar o limite de disco: {e}")
+                    traceback.print_exc()
+
+    def _aplicar_limite_disco(self):
+        """Descarta workspaces de jobs terminados (LRU) acima do limite de disco.
+
+        Jobs à espera da narrativa do LLM, ainda indexando itens ou com clientes
+        acompanhando ficam de fora; os recém-concluídos estão protegidos pela carência do ArtifactManager.
+        """
+        with self.cond:
+            candidatos = {
+                job_id for job_id, job in self.jobs.items()
+                if job["status"] in JOB_STATUS_FINAIS
+                and not job.get("narrativa_pendente")
+                and job.get("indexacao") != "executando"
+                and not self.seguidores.get(job_id)
+            }
+        removidos = self.artifacts.enforce_limit(candidatos)
+        with self.cond:
+            for job_id in removidos:
+                self.jobs.pop(job_id, None)
+
+def run_job(manager, job_id):
+    """Executa (ou retoma) as etapas extração → parse → análise de um job"""
+    job = manager.obter(job_id)
+    job_dir = manager.job_dir(job_id)
+    xml_dir = os.path.join(job_dir, "xml")
+    extracao_ok = os.path.join(job_dir, "extracao.ok")
+    csv_path = os.path.join(job_dir, "notas_fiscais.csv")
+    db_path = os.path.join(job_dir, "itens.sqlite")
+    resultado_path = os.path.join(job_dir, "resultado.json")
+    graficos_path = os.path.join(job_dir, "graficos.json")
+    start_time = time.time()
+
+    manager.atualizar(job_id, status="executando")
+
+    # Etapa 1 + 2: extração e parse (pulados se a tabela unificada já existe)
+    if os.path.exists(csv_path):
+        df = load_parsed_table(csv_path)
+    else:
+        if not os.path.exists(extracao_ok):
+            manager.atualizar(job_id, etapa="extracao", mensagem="📦 Extraindo arquivo compactado...")
+            shutil.rmtree(xml_dir, ignore_errors=True)
+            extract_archive(job["arquivo"], xml_dir)
+            Path(extracao_ok).touch()
+
+        xml_files = list(Path(xml_dir).rglob("*.xml"))
+        if not xml_files:
+            manager.atualizar(job_id, status="erro", etapa=None,
+                              mensagem="❌ Nenhum arquivo XML encontrado no arquivo compactado.")
             return
-        
-        # Criar DataFrame
-        df = pd.DataFrame(nfe_data)
-        df["valor_nf"] = pd.to_numeric(df["valor_nf"], errors="coerce")
-        
-        # Salvar CSV
-        csv_path = os.path.join(temp_dir, "notas_fiscais.csv")
-        df.to_csv(csv_path, sep=";", index=False, encoding="utf-8")
-        
-        state.df = df
-        state.csv_path = csv_path
-        
-        yield (
-            f"✅ {len(nfe_data)} notas fiscais processadas!\n\n🤖 Iniciando análise com Gemini 2.5 Flash...",
-            df.head(20),
-            csv_path,
-            None, None, None,
-            gr.update(interactive=False)
-        )
-        
-        # Análise com Gemini
-        analysis_text, plots = perform_autonomous_analysis(df)
-        
+
+        manager.atualizar(job_id, etapa="parse", mensagem=f"📦 Processando {len(xml_files)} arquivos XML...")
+        df, contagem = parse_xml_files(xml_files)
+        manager.atualizar(job_id, documentos=contagem)
+        print(format_document_counts(contagem))
+        if df is None:
+            manager.atualizar(job_id, status="erro", etapa=None,
+                              mensagem=f"❌ Não foi possível processar nenhum XML válido.\n\n{format_document_counts(contagem)}")
+            return
+
+        save_atomic(csv_path, lambda p: df.to_csv(p, sep=";", index=False, encoding="utf-8"))
+        manager.artifacts.release_inputs(job_id)
+
+    manager.atualizar(
+        job_id,
+        etapa="analise",
+        csv_path=csv_path,
+        mensagem=(f"✅ {len(df)} notas fiscais processadas!\n\n"
+                  f"{format_document_counts(manager.obter(job_id).get('documentos'))}\n\n"
+                  "🤖 Iniciando análise com Gemini 2.5 Flash..."),
+    )
+
+    # Etapa 3: análise (pulada se o resultado já foi salvo). O prazo de
+    # ANALISE_SLA_S conta do início do job; a narrativa tardia do LLM só é
+    # publicada depois que o resultado local já estiver disponível
+    publicado = threading.Event()
+
+    def on_narrative(full_analysis):
+        publicado.wait()
+        publish_late_narrative(manager, job_id, full_analysis)
+
+    # Itens do JSON decodificados uma vez, compartilhados pela análise e pelo índice
+    itens = None
+    try:
+        analise_retomada = os.path.exists(resultado_path)
+        if not analise_retomada:
+            prazo = time.monotonic() + ANALISE_SLA_S - (time.time() - start_time)
+            itens = decode_items(df)
+            analysis_text, plots, analysis_results = perform_autonomous_analysis(
+                df, output_dir=job_dir, prazo=prazo, on_narrative=on_narrative, itens=itens
+            )
+            # Séries dos gráficos antes do resultado: resultado salvo implica séries salvas
+            if analysis_results.get("chart_series"):
+                save_result(graficos_path, analysis_results["chart_series"])
+            save_result(resultado_path, {
+                "full_analysis": analysis_text,
+                "plots": plots,
+                "co2_summary": analysis_results.get("co2_summary", {}),
+                "narrativa_pendente": analysis_results.get("narrativa_pendente", False),
+            })
+
+        with open(resultado_path, encoding="utf-8") as f:
+            resultado = json.load(f)
+
+        # Análise pulada na retomada: a thread que traria a narrativa morreu com o processo
+        aviso = ""
+        if analise_retomada and resultado.get("narrativa_pendente"):
+            resultado["narrativa_pendente"] = False
+            save_result(resultado_path, resultado)
+            aviso = "\n\n⚠️ A análise da IA não ficou disponível; o relatório local é o definitivo."
+
         elapsed = int(time.time() - start_time)
-        final_msg = f"""✅ ANÁLISE CONCLUÍDA EM {elapsed}s
+        manager.atualizar(
+            job_id,
+            status="concluido",
+            etapa=None,
+            mensagem=final_message(resultado["full_analysis"], elapsed, manager.obter(job_id).get("documentos")) + aviso,
+            plots=resultado["plots"],
+            tempo_s=elapsed,
+            narrativa_pendente=resultado.get("narrativa_pendente", False),
+        )
+    finally:
+        publicado.set()
+
+    # Etapa 4: índice do explorador, depois do resultado publicado (fora do prazo
+    # da análise). Falha aqui não invalida o resultado: só o explorador fica indisponível
+    if not os.path.exists(db_path):
+        manager.atualizar(job_id, indexacao="executando")
+        try:
+            build_items_db(df, db_path, itens)
+        except Exception as e:
+            print(f"✗ Falha ao indexar itens do job {job_id}: {e}")
+            traceback.print_exc()
+            manager.atualizar(job_id, indexacao="erro")
+            return
+    manager.atualizar(job_id, indexacao="concluida")
 
-{analysis_text}
+def save_result(resultado_path, resultado):
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2, default=str)
+    save_atomic(resultado_path, write)
+
+def final_message(full_analysis, elapsed, documentos=None):
+    return f"""✅ ANÁLISE CONCLUÍDA EM {elapsed}s
+
+{format_document_counts(documentos)}
+
+{full_analysis}
 
 💬 Você pode fazer perguntas adicionais no chat interativo abaixo."""
-        
-        yield (
-            final_msg,
-            df.head(20),
-            csv_path,
-            plots[0], plots[1], plots[2],
-            gr.update(interactive=True)
+
+def publish_late_narrative(manager, job_id, full_analysis):
+    """Troca o relatório local pela narrativa do LLM que chegou depois do prazo"""
+    job = manager.obter(job_id)
+    if job is None or job["status"] != "concluido":
+        return
+
+    resultado_path = os.path.join(manager.job_dir(job_id), "resultado.json")
+    try:
+        with open(resultado_path, encoding="utf-8") as f:
+            resultado = json.load(f)
+        resultado["narrativa_pendente"] = False
+        if full_analysis is not None:
+            resultado["full_analysis"] = full_analysis
+        save_result(resultado_path, resultado)
+    except FileNotFoundError:
+        # Workspace descartado pela limpeza de artefatos nesse meio-tempo
+        return
+
+    if full_analysis is not None:
+        mensagem = final_message(full_analysis, job["tempo_s"], job.get("documentos"))
+        print(f"✓ Job {job_id}: narrativa Gemini recebida e publicada")
+    else:
+        mensagem = job["mensagem"] + "\n\n⚠️ A análise da IA não ficou disponível; o relatório local é o definitivo."
+    manager.atualizar(job_id, mensagem=mensagem, narrativa_pendente=False)
+
+artifact_manager = ArtifactManager(JOBS_DIR, ARTIFACTS_MAX_MB * 1024**2, ARTIFACTS_CARENCIA_S)
+job_manager = JobManager(artifact_manager, JOB_MAX_WORKERS, JOB_MAX_POR_USUARIO)
+
+# ===========================================================
+# ACOMPANHAMENTO DE JOBS NA INTERFACE
+# ===========================================================
+def identify_user(request):
+    """Identifica o usuário para o limite de concorrência (login ou IP)"""
+    if request is None:
+        return "anonimo"
+    if getattr(request, "username", None):
+        return request.username
+    client_info = getattr(request, "client", None)
+    return getattr(client_info, "host", None) or "anonimo"
+
+def idle_outputs(mensagem, job_id, tabela=None, csv_path=None):
+    """Saídas da interface sem resultados (job em andamento, com erro ou inexistente)"""
+    return (mensagem, tabela, csv_path, None, None, None, None, None, None,
+            gr.update(interactive=False), job_id)
+
+def job_outputs(job):
+    """Converte o estado do job nas saídas da interface"""
+    if job["status"] == "erro":
+        return idle_outputs(job["mensagem"], job["id"])
+
+    tabela = None
+    if job.get("csv_path") and os.path.exists(job["csv_path"]):
+        tabela = load_parsed_table(job["csv_path"], nrows=20)
+
+    if job["status"] == "concluido":
+        if not os.path.exists(os.path.join(job_manager.job_dir(job["id"]), "resultado.json")):
+            return idle_outputs(f"❌ Os resultados do job '{job['id']}' expiraram pela limpeza de artefatos. "
+                                "Envie o arquivo novamente.", job["id"])
+        plots = job["plots"]
+        graficos = chart_plot_values(load_chart_series(job["id"]))
+        return (
+            job["mensagem"], tabela, job["csv_path"],
+            plots[0], plots[1], plots[2], *graficos,
+            gr.update(interactive=True), job["id"],
         )
-        
+
+    return idle_outputs(job["mensagem"], job["id"], tabela, job.get("csv_path"))
+
+def follow_job(job_id):
+    """Transmite o progresso de um job até ele terminar (reconexão segura)"""
+    job_id = (job_id or "").strip()
+    job = job_manager.obter(job_id)
+    if job is None:
+        yield idle_outputs(f"❌ Job '{job_id}' não encontrado (pode ter expirado pela limpeza de artefatos).", job_id)
+        return
+
+    job_manager.artifacts.touch(job_id)
+    job_manager.seguir(job_id)
+    try:
+        versao = None
+        while True:
+            if job["versao"] != versao:
+                versao = job["versao"]
+                yield job_outputs(job)
+            # Com relatório local publicado, continua aguardando a narrativa tardia do LLM
+            if job["status"] in JOB_STATUS_FINAIS and not job.get("narrativa_pendente"):
+                return
+            job = job_manager.aguardar_mudanca(job_id, versao, JOB_POLL_INTERVAL)
+            if job is None:
+                yield idle_outputs(f"❌ Os resultados do job '{job_id}' expiraram pela limpeza de artefatos. "
+                                   "Envie o arquivo novamente.", job_id)
+                return
+    finally:
+        job_manager.deixar(job_id)
+
+def process_archive(uploaded_file, request: gr.Request = None):
+    if uploaded_file is None:
+        yield idle_outputs("❌ Envie um arquivo .zip ou .7z.", "")
+        return
+
+    try:
+        file_path = uploaded_file.name if hasattr(uploaded_file, 'name') else uploaded_file
+        if not file_path.endswith((".zip", ".7z")):
+            raise ValueError("Formato de arquivo não suportado. Use .zip ou .7z")
+        job_id = job_manager.submeter(file_path, identify_user(request))
     except Exception as e:
-        yield f"❌ Erro: {str(e)}", None, None, None, None, None, gr.update(interactive=False)
+        yield idle_outputs(f"❌ Erro: {str(e)}", "")
+        return
+
+    yield from follow_job(job_id)
+
+# ===========================================================
+# GRÁFICOS INTERATIVOS (SÉRIES AGREGADAS EM CACHE)
+# ===========================================================
+# Séries de gráficos mantidas em memória (LRU por job); o resto fica em graficos.json
+GRAFICOS_CACHE_MAX = 32
+
+chart_cache = OrderedDict()
+chart_cache_lock = threading.Lock()
+
+def load_chart_series(job_id):
+    """Séries agregadas de um job como DataFrames (None se o job não as tiver)"""
+    # Job expirado não é servido do cache: o workspace dele já não existe
+    if job_manager.obter(job_id) is None:
+        with chart_cache_lock:
+            chart_cache.pop(job_id, None)
+        return None
+    with chart_cache_lock:
+        if job_id in chart_cache:
+            chart_cache.move_to_end(job_id)
+            return chart_cache[job_id]
+
+    try:
+        with open(os.path.join(job_manager.job_dir(job_id), "graficos.json"), encoding="utf-8") as f:
+            frames = chart_frames(json.load(f))
+    except FileNotFoundError:
+        return None
+    for nome in ('top_itens', 'top_itens_mensal'):
+        frames[nome]['item'] = frames[nome]['descricao'].apply(short_description)
+
+    with chart_cache_lock:
+        chart_cache[job_id] = frames
+        while len(chart_cache) > GRAFICOS_CACHE_MAX:
+            chart_cache.popitem(last=False)
+    return frames
+
+def chart_plot_values(frames, de="", ate=""):
+    """Valores dos gráficos nativos, com os meses limitados a [de, ate] (vazio = sem limite).
+
+    O top de itens de um período é somado dos valores mensais em cache; sem
+    período (ou em séries antigas, sem valores mensais) vale o top do dataset.
+    """
+    if frames is None:
+        return None, None, None
+    if de and ate and de > ate:
+        de, ate = ate, de
+
+    def periodo(serie):
+        mask = pd.Series(True, index=serie.index)
+        if de:
+            mask &= serie['mes_ano'] >= de
+        if ate:
+            mask &= serie['mes_ano'] <= ate
+        return serie[mask]
+
+    top_itens = frames['top_itens']
+    if (de or ate) and len(frames['top_itens_mensal']):
+        top_itens = (periodo(frames['top_itens_mensal'])
+                     .groupby(['produto', 'descricao', 'item'], sort=False)['valor'].sum()
+                     .nlargest(GRAFICOS_TOP_ITENS).reset_index())
+    return periodo(frames['gastos_mensais']), top_itens, periodo(frames['co2_mensal'])
+
+def filter_charts(job_id, de, ate):
+    """Aplica o período aos gráficos a partir das séries em cache (sem matplotlib)"""
+    job_id = (job_id or "").strip()
+    frames = load_chart_series(job_id)
+    meses = [""] + (frames['gastos_mensais']['mes_ano'].tolist() if frames is not None else [])
+    return (*chart_plot_values(frames, de, ate),
+            gr.update(choices=meses), gr.update(choices=meses))
+
+def export_chart_pngs(job_id):
+    """Exporta os gráficos em PNG sob demanda (reaproveita os já renderizados no workspace)"""
+    job_id = (job_id or "").strip()
+    frames = load_chart_series(job_id)
+    if frames is None:
+        raise gr.Error(f"Job '{job_id}' sem gráficos disponíveis (não concluído ou expirado).")
+
+    job_dir = job_manager.job_dir(job_id)
+    nomes = ["monthly_spending.png", "top_items.png", "co2_emissions.png"]
+    paths = [os.path.join(job_dir, nome) for nome in nomes]
+    if not all(os.path.exists(path) for path in paths):
+        paths = render_chart_pngs(frames, job_dir)
+    job_manager.artifacts.touch(job_id)
+    return [path for path in paths if path]
 
 # ===========================================================
 # CHAT INTERATIVO
 # ===========================================================
-def chat_response(message, history):
-    if state.df is None:
+# Estatísticas do dataset de cada job para o contexto do chat (LRU por job).
+# O chat de cada sessão responde sobre o job do seu campo "ID do Job"
+CHAT_CACHE_MAX = 32
+
+chat_stats_cache = OrderedDict()
+chat_stats_cache_lock = threading.Lock()
+
+def load_chat_context(job_id):
+    """(análise, estatísticas do dataset) de um job concluído, ou None"""
+    job = job_manager.obter(job_id) if job_id else None
+    if job is None or job["status"] != "concluido":
+        return None
+    try:
+        # Sempre do disco: a narrativa tardia do LLM pode ter trocado a análise
+        with open(os.path.join(job_manager.job_dir(job_id), "resultado.json"), encoding="utf-8") as f:
+            full_analysis = json.load(f).get("full_analysis")
+    except FileNotFoundError:
+        return None
+
+    with chat_stats_cache_lock:
+        stats = chat_stats_cache.get(job_id)
+        if stats is not None:
+            chat_stats_cache.move_to_end(job_id)
+    if stats is None:
+        df = load_parsed_table(job["csv_path"])
+        datas = parse_emission_dates(df['data_emissao'], infer_schema(df))
+        stats = {"registros": len(df), "valor_total": df['valor_nf'].sum(),
+                 "inicio": datas.min(), "fim": datas.max()}
+        with chat_stats_cache_lock:
+            chat_stats_cache[job_id] = stats
+            while len(chat_stats_cache) > CHAT_CACHE_MAX:
+                chat_stats_cache.popitem(last=False)
+    job_manager.artifacts.touch(job_id)
+    return full_analysis, stats
+
+def chat_response(message, history, job_id):
+    contexto = load_chat_context((job_id or "").strip())
+    if contexto is None:
         return history + [(message, "⚠️ Por favor, processe um arquivo primeiro.")]
+    full_analysis, stats = contexto
     
     # Preparar contexto
     context = f"""Você tem acesso aos seguintes dados analisados:
 
 ANÁLISE PRÉVIA:
-{state.analysis_results.get('full_analysis', 'Análise não disponível')}
+{full_analysis or 'Análise não disponível'}
 
 ESTATÍSTICAS DO DATASET:
-- Total de registros: {len(state.df)}
-- Valor total: R$ {state.df['valor_nf'].sum():,.2f}
-- Período: {pd.to_datetime(state.df['data_emissao']).min()} a {pd.to_datetime(state.df['data_emissao']).max()}
+- Total de registros: {stats['registros']}
+- Valor total: R$ {stats['valor_total']:,.2f}
+- Período: {stats['inicio']} a {stats['fim']}
 
 PERGUNTA DO USUÁRIO:
 {message}
@@ -792,7 +2638,7 @@ Responda de forma precisa e baseada nos dados."""
 # ===========================================================
 # INTERFACE GRADIO
 # ===========================================================
-with gr.Blocks(title="Processador NF-e com IA", theme=gr.themes.Soft()) as demo:
+with gr.Blocks(title="Processador NF-e com IA", theme=gr.themes.Soft(), delete_cache=GRADIO_CACHE_LIMPEZA) as demo:
     gr.Markdown("""
     # 📊 Processador Inteligente de Notas Fiscais (NF-e)
     ### Powered by Gemini 2.5 Flash
@@ -808,17 +2654,68 @@ with gr.Blocks(title="Processador NF-e com IA", theme=gr.themes.Soft()) as demo:
     
     botao = gr.Button("🚀 Processar e Analisar", variant="primary", size="lg")
     
+    with gr.Row():
+        job_id_box = gr.Textbox(
+            label="🆔 ID do Job",
+            placeholder="Guarde este ID para acompanhar o processamento depois",
+            scale=4
+        )
+        reconectar_btn = gr.Button("🔄 Acompanhar Job", scale=1)
+    
     saida_texto = gr.Markdown("Aguardando arquivo...")
     
     gr.Markdown("## 📋 Dados Consolidados")
     tabela_csv = gr.Dataframe(label="Amostra do CSV Unificado", interactive=False)
     csv_download = gr.File(label="⬇️ Baixar CSV Completo")
     
+    gr.Markdown("## 🔎 Explorador de Itens")
+    with gr.Row():
+        filtro_mes = gr.Dropdown(label="Mês/Ano (vazio = todos)", choices=[""], value="", allow_custom_value=True)
+        filtro_cnpj = gr.Textbox(label="CNPJ do fornecedor")
+        filtro_ncm = gr.Textbox(label="NCM (prefixo)")
+        filtro_cfop = gr.Textbox(label="CFOP")
+    with gr.Row():
+        ordenar_por = gr.Dropdown(label="Ordenar por", choices=ITEM_SORT_COLUMNS, value="data_emissao")
+        ordem = gr.Radio(["Crescente", "Decrescente"], value="Decrescente", label="Ordem")
+        pagina = gr.Number(label="Página", value=1, precision=0, minimum=1)
+    cursor_explorador = gr.State(None)
+    with gr.Row():
+        anterior_btn = gr.Button("⬅️ Anterior")
+        buscar_btn = gr.Button("🔎 Buscar", variant="primary")
+        proxima_btn = gr.Button("Próxima ➡️")
+    explorador_info = gr.Markdown()
+    explorador_tabela = gr.Dataframe(label="Itens (página atual)", interactive=False)
+    
     gr.Markdown("## 📈 Visualizações Geradas pela IA")
     
-    plot1 = gr.Image(label="💰 Gastos Mensais")
-    plot2 = gr.Image(label="🛒 Top 10 Itens")
-    plot3 = gr.Image(label="🌱 Emissões de CO₂")
+    # Modo "nativo": o navegador desenha as séries agregadas; modo "png": imagens prontas
+    graficos_nativos = GRAFICOS_MODO != "png"
+    with gr.Row(visible=graficos_nativos):
+        periodo_de = gr.Dropdown(label="De (Mês/Ano)", choices=[""], value="", allow_custom_value=True)
+        periodo_ate = gr.Dropdown(label="Até (Mês/Ano)", choices=[""], value="", allow_custom_value=True)
+        periodo_btn = gr.Button("📅 Aplicar Período")
+    grafico_mensal = gr.BarPlot(
+        x="mes_ano", y="valor_nf", sort="x", label="💰 Gastos Mensais",
+        x_title="Mês/Ano", y_title="Valor Total (R$)", x_label_angle=-45,
+        show_fullscreen_button=True, visible=graficos_nativos
+    )
+    grafico_itens = gr.BarPlot(
+        x="item", y="valor", sort="-y", label="🛒 Top 10 Itens (no período)",
+        x_title="Item", y_title="Valor Total (R$)", x_label_angle=-30,
+        tooltip=["descricao", "valor"], show_fullscreen_button=True, visible=graficos_nativos
+    )
+    grafico_co2 = gr.LinePlot(
+        x="mes_ano", y="co2_kg", sort="x", label="🌱 Emissões de CO₂",
+        x_title="Mês/Ano", y_title="Emissões de CO₂ (kg)", x_label_angle=-45,
+        show_fullscreen_button=True, visible=graficos_nativos
+    )
+    
+    plot1 = gr.Image(label="💰 Gastos Mensais", visible=not graficos_nativos)
+    plot2 = gr.Image(label="🛒 Top 10 Itens", visible=not graficos_nativos)
+    plot3 = gr.Image(label="🌱 Emissões de CO₂", visible=not graficos_nativos)
+    
+    exportar_png_btn = gr.Button("🖼️ Exportar Gráficos em PNG")
+    graficos_png = gr.File(label="⬇️ Gráficos em PNG", file_count="multiple")
     
     gr.Markdown("## 💬 Chat Interativo com IA")
     chatbot = gr.Chatbot(label="Converse sobre os dados", height=400)
@@ -831,16 +2728,72 @@ with gr.Blocks(title="Processador NF-e com IA", theme=gr.themes.Soft()) as demo:
         submit_btn = gr.Button("Enviar", variant="primary")
     clear_btn = gr.Button("🗑️ Limpar Chat")
     
+    with gr.Accordion("📈 Métricas da API Gemini", open=False):
+        metricas_llm = gr.Markdown()
+        atualizar_metricas_btn = gr.Button("🔄 Atualizar Métricas")
+    
     # Eventos
+    job_outputs_ui = [saida_texto, tabela_csv, csv_download, plot1, plot2, plot3,
+                      grafico_mensal, grafico_itens, grafico_co2, chat_input, job_id_box]
+    
+    # O trabalho pesado roda na fila de jobs; estes eventos só acompanham o
+    # progresso, então não precisam ocupar um worker exclusivo do Gradio
     botao.click(
         fn=process_archive,
         inputs=arquivo_input,
-        outputs=[saida_texto, tabela_csv, csv_download, plot1, plot2, plot3, chat_input]
+        outputs=job_outputs_ui,
+        concurrency_limit=None
+    )
+    
+    reconectar_btn.click(
+        fn=follow_job,
+        inputs=job_id_box,
+        outputs=job_outputs_ui,
+        concurrency_limit=None
+    )
+    
+    explorador_inputs = [job_id_box, filtro_mes, filtro_cnpj, filtro_ncm, filtro_cfop, ordenar_por, ordem]
+    explorador_outputs = [explorador_tabela, explorador_info, pagina, filtro_mes, cursor_explorador]
+    
+    buscar_btn.click(
+        fn=lambda *args: browse_items(*args, 1),
+        inputs=explorador_inputs,
+        outputs=explorador_outputs
+    )
+    
+    anterior_btn.click(
+        fn=lambda *args: browse_items(*args[:-2], (args[-2] or 1) - 1, args[-1]),
+        inputs=explorador_inputs + [pagina, cursor_explorador],
+        outputs=explorador_outputs
+    )
+    
+    proxima_btn.click(
+        fn=lambda *args: browse_items(*args[:-2], (args[-2] or 1) + 1, args[-1]),
+        inputs=explorador_inputs + [pagina, cursor_explorador],
+        outputs=explorador_outputs
+    )
+    
+    pagina.submit(
+        fn=browse_items,
+        inputs=explorador_inputs + [pagina, cursor_explorador],
+        outputs=explorador_outputs
+    )
+    
+    periodo_btn.click(
+        fn=filter_charts,
+        inputs=[job_id_box, periodo_de, periodo_ate],
+        outputs=[grafico_mensal, grafico_itens, grafico_co2, periodo_de, periodo_ate]
+    )
+    
+    exportar_png_btn.click(
+        fn=export_chart_pngs,
+        inputs=job_id_box,
+        outputs=graficos_png
     )
     
     submit_btn.click(
         fn=chat_response,
-        inputs=[chat_input, chatbot],
+        inputs=[chat_input, chatbot, job_id_box],
         outputs=[chatbot]
     ).then(
         lambda: "",
@@ -850,7 +2803,7 @@ with gr.Blocks(title="Processador NF-e com IA", theme=gr.themes.Soft()) as demo:
     
     chat_input.submit(
         fn=chat_response,
-        inputs=[chat_input, chatbot],
+        inputs=[chat_input, chatbot, job_id_box],
         outputs=[chatbot]
     ).then(
         lambda: "",
@@ -859,6 +2812,10 @@ with gr.Blocks(title="Processador NF-e com IA", theme=gr.themes.Soft()) as demo:
     )
     
     clear_btn.click(lambda: None, None, chatbot)
+    
+    atualizar_metricas_btn.click(llm_gateway.resumo_metricas, None, metricas_llm)
 
 if __name__ == "__main__":
+    # Recupera jobs interrompidos já na subida, sem esperar o primeiro acesso
+    job_manager.iniciar()
     demo.launch()
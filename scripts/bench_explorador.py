@@ -0,0 +1,131 @@
+"""Verificação de tempo do explorador de itens: monta itens.sqlite com 1M itens sintéticos e
+mede as consultas de página (filtros combinados, ordenações, páginas profundas e keyset).
+
+Sai com código 1 se alguma consulta passar do alvo.
+
+Uso:
+  python scripts/bench_explorador.py                  # 1M itens, alvo de 100 ms por página
+  python scripts/bench_explorador.py --itens 200000 --alvo-ms 50
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+ITENS_POR_NOTA = 10
+CFOPS = (["5102", "5405", "6102", "5101", "5949"], [0.70, 0.15, 0.10, 0.04, 0.01])
+
+def zipf_pesos(n, expoente=1.0):
+    pesos = 1 / np.arange(1, n + 1) ** expoente
+    return pesos / pesos.sum()
+
+def gerar_notas(n_itens, seed=0):
+    """Notas sintéticas no formato da tabela unificada (coluna 'itens' em JSON)"""
+    rng = np.random.default_rng(seed)
+    n_notas = n_itens // ITENS_POR_NOTA
+    cnpjs = [f"{rng.integers(10**13, 10**14):014d}" for _ in range(500)]
+    ncms = [f"{capitulo:02d}{rng.integers(0, 10**6):06d}" for capitulo in rng.integers(1, 97, 2000)]
+    descricoes = [f"PRODUTO {i} {rng.choice(['CX', 'UN', 'KG', 'L'])}" for i in range(20000)]
+
+    fornecedor = rng.choice(len(cnpjs), n_notas, p=zipf_pesos(len(cnpjs)))
+    dias = rng.integers(0, 730, n_notas)
+    datas = (np.datetime64("2023-01-01T08:00:00") + dias.astype("timedelta64[D]")).astype(str)
+    produto = rng.choice(len(descricoes), (n_notas, ITENS_POR_NOTA), p=zipf_pesos(len(descricoes), 0.8))
+    cfop = rng.choice(CFOPS[0], (n_notas, ITENS_POR_NOTA), p=CFOPS[1])
+    valores = np.round(rng.lognormal(3, 1, (n_notas, ITENS_POR_NOTA)), 2)
+
+    notas = []
+    for i in range(n_notas):
+        itens = [{
+            "item": str(k + 1), "codigo": f"P{produto[i, k]}", "descricao": descricoes[produto[i, k]],
+            "ncm": ncms[produto[i, k] % len(ncms)], "cfop": cfop[i, k], "unidade": "UN",
+            "quantidade": "1", "valor_unitario": str(valores[i, k]), "valor_total": str(valores[i, k]),
+        } for k in range(ITENS_POR_NOTA)]
+        notas.append({
+            "chave": f"NFe{i:044d}", "numero": str(i), "data_emissao": f"{datas[i]}-03:00",
+            "emitente_cnpj": cnpjs[fornecedor[i]], "emitente_nome": f"FORNECEDOR {fornecedor[i]}",
+            "valor_nf": str(valores[i].sum()), "versao": "4.00", "itens": json.dumps(itens),
+        })
+    return pd.DataFrame(notas), cnpjs, ncms
+
+def medir(db_path, repeticoes=3, **consulta):
+    """Melhor tempo (ms) de uma página, com o cache do SO já aquecido"""
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = app.query_items(db_path, **consulta)
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    return min(tempos), resultado
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempo das consultas do explorador de itens")
+    parser.add_argument("--itens", type=int, default=1_000_000)
+    parser.add_argument("--alvo-ms", type=float, default=100.0)
+    args = parser.parse_args()
+
+    inicio = time.time()
+    df, cnpjs, ncms = gerar_notas(args.itens)
+    print(f"✓ {len(df):,} notas sintéticas geradas ({time.time() - inicio:.1f}s)")
+
+    db_path = os.path.join(tempfile.mkdtemp(), "itens.sqlite")
+    inicio = time.time()
+    app.build_items_db(df, db_path)
+    print(f"✓ Índice: {time.time() - inicio:.1f}s, {os.path.getsize(db_path) / 1024**2:.0f} MB")
+
+    meses = app.list_item_months(db_path)
+    cnpj_grande, cnpj_pequeno = cnpjs[0], cnpjs[-1]
+    casos = [
+        ("sem filtro, data ↓", {}),
+        ("sem filtro, valor ↑, última página", {"ordenar_por": "valor_total", "descendente": False, "pagina": 10**9}),
+        ("mês, valor ↓", {"mes": meses[5], "ordenar_por": "valor_total"}),
+        ("mês + CFOP, valor ↓", {"mes": meses[5], "cfop": "5102", "ordenar_por": "valor_total"}),
+        ("mês + CFOP raro, descrição ↑", {"mes": meses[5], "cfop": "5949", "ordenar_por": "descricao", "descendente": False}),
+        ("NCM posição, descrição ↑", {"ncm": ncms[0][:4], "ordenar_por": "descricao", "descendente": False}),
+        ("NCM capítulo + mês, descrição ↓", {"ncm": ncms[0][:2], "mes": meses[3], "ordenar_por": "descricao"}),
+        ("CNPJ grande, data ↓", {"cnpj": cnpj_grande}),
+        ("CNPJ grande, data ↓, página 200", {"cnpj": cnpj_grande, "pagina": 200}),
+        ("CNPJ pequeno + CFOP, valor ↓", {"cnpj": cnpj_pequeno, "cfop": "5102", "ordenar_por": "valor_total"}),
+        ("CFOP dominante, valor ↑, página 5000", {"cfop": "5102", "ordenar_por": "valor_total",
+                                                 "descendente": False, "pagina": 5000}),
+        ("todos os filtros", {"mes": meses[5], "cnpj": cnpj_grande, "ncm": ncms[0][:2], "cfop": "5102"}),
+    ]
+
+    piores = []
+    print(f"\n{'consulta':<42} {'ms':>8} {'itens':>10}")
+    for nome, consulta in casos:
+        ms, (_, total, _, cursor) = medir(db_path, **consulta)
+        piores.append(ms)
+        print(f"{nome:<42} {ms:>8.1f} {total:>10,}")
+
+        # Próximas páginas pelo cursor (keyset), como nos botões da interface
+        if nome in ("mês, valor ↓", "CFOP dominante, valor ↑, página 5000"):
+            pagina = cursor["pagina"]
+            for _ in range(3):
+                pagina += 1
+                ms, (pagina_df, _, pagina, cursor) = medir(db_path, repeticoes=1,
+                                                          **{**consulta, "pagina": pagina, "cursor": cursor})
+                piores.append(ms)
+                # Keyset precisa devolver exatamente a mesma página que o OFFSET
+                esperado = app.query_items(db_path, **{**consulta, "pagina": pagina})[0]
+                if not pagina_df.equals(esperado):
+                    print(f"✗ Página {pagina} por keyset difere da página por OFFSET")
+                    sys.exit(1)
+            print(f"{'  └ +3 páginas por keyset (pior)':<42} {max(piores[-3:]):>8.1f}")
+
+    pior = max(piores)
+    print(f"\nPior página: {pior:.1f} ms (alvo: {args.alvo_ms:.0f} ms)")
+    if pior > args.alvo_ms:
+        print("✗ Alvo de tempo não atingido")
+        sys.exit(1)
+    print("✓ Alvo de tempo atingido")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Benchmark do agrupamento de produtos (item_products): velocidade e qualidade em itens sintéticos.
+
+Gera notas com produtos conhecidos escritos de várias formas (acentos, caixa,
+unidades, abreviações do fornecedor, preços com milhar) e fornecedores que usam
+um cProd constante para tudo. Mede o tempo com o cache de normalização frio e
+quente e compara os grupos com os produtos reais:
+  grupos por produto real   fragmentação (1.00 = cada produto num só grupo)
+  pureza                    fração dos itens no produto majoritário do seu grupo
+  top-10                    produtos reais do top 10 que o agrupamento recupera
+
+Uso:
+  python scripts/bench_produtos.py                  # 1M itens
+  python scripts/bench_produtos.py --itens 200000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+PALAVRAS = ["CAFÉ", "AÇÚCAR", "SABÃO", "ÁLCOOL", "FEIJÃO", "ARROZ", "PAPEL", "CABO", "ELÉTRICO", "TORRADO",
+            "REFINADO", "LÍQUIDO", "DETERGENTE", "LUVA", "LÁTEX", "TINTA", "ACRÍLICA", "CIMENTO", "CANETA",
+            "ESFEROGRÁFICA", "ÓLEO", "SOJA", "LEITE", "INTEGRAL", "MACARRÃO", "PARAFUSO", "TUBO", "PVC",
+            "LÂMPADA", "LED", "CADEIRA", "GIRATÓRIA", "ÁGUA", "MINERAL", "COPO", "DESCARTÁVEL", "ARAME"]
+UNIDADES = {"G": ["G", " G", "GR", " GR", " GRS", " GRAMAS"], "KG": ["KG", " KG", " KGS", " QUILOS"],
+            "ML": ["ML", " ML"], "L": ["L", " L", "LT", " LT", " LTS", " LITROS"],
+            "M": ["M", " M", "MT", " MTS", " METROS"], "UN": ["UN", " UN", " UND", " UNID"]}
+# Medidas em formato brasileiro e sua forma com ponto decimal
+MEDIDAS = [("1", "1"), ("2", "2"), ("5", "5"), ("500", "500"), ("1,5", "1.5"), ("2,5", "2.5"),
+           ("0,5", "0.5"), ("1.000", "1000"), ("2.500", "2500")]
+N_PRODUTOS, N_FORNECEDORES, ITENS_POR_NOTA = 3000, 300, 10
+FRACAO_CODIGO_CONSTANTE = 0.1
+
+def sem_acentos(texto):
+    return unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+
+def gerar_notas(n_itens, seed=7):
+    """Notas sintéticas e o produto real de cada item (na ordem de decode_items)"""
+    rng = random.Random(seed)
+    nrng = np.random.default_rng(seed)
+    produtos = []
+    for _ in range(N_PRODUTOS):
+        nome = " ".join(rng.sample(PALAVRAS, rng.randint(2, 4)))
+        produtos.append((nome, rng.choice(MEDIDAS), rng.choice(list(UNIDADES)), f"{rng.randint(10**7, 10**8 - 1)}"))
+
+    def variante(p):
+        nome, (medida, medida_ponto), unidade, _ = produtos[p]
+        if rng.random() < 0.5:
+            nome = sem_acentos(nome)
+        if rng.random() < 0.15:
+            nome = nome.replace(" ", "  ", 1)
+        if rng.random() < 0.1:
+            nome = nome.replace(" ", " - ", 1)
+        texto = f"{nome} {medida if rng.random() < 0.5 else medida_ponto}{rng.choice(UNIDADES[unidade])}"
+        if rng.random() < 0.2:
+            texto += " UN"
+        caixa = rng.random()
+        return texto.lower() if caixa < 0.15 else texto.title() if caixa < 0.3 else texto
+
+    def abreviada(texto):
+        # Abreviação própria do fornecedor: só o código do fornecedor a resolve
+        tokens = texto.split()
+        i = rng.randrange(len(tokens))
+        tokens[i] = tokens[i][:max(3, len(tokens[i]) - 3)] + "."
+        return " ".join(tokens)
+
+    peso = 1 / np.arange(1, N_PRODUTOS + 1) ** 0.8
+    catalogo = [rng.sample(range(N_PRODUTOS), 400) for _ in range(N_FORNECEDORES)]
+    codigo_constante = set(rng.sample(range(N_FORNECEDORES), int(N_FORNECEDORES * FRACAO_CODIGO_CONSTANTE)))
+    estilo = {}
+    notas, reais = [], []
+    for i in range(n_itens // ITENS_POR_NOTA):
+        f = rng.randrange(N_FORNECEDORES)
+        pesos = peso[catalogo[f]] / peso[catalogo[f]].sum()
+        itens = []
+        for k, p in enumerate(nrng.choice(catalogo[f], ITENS_POR_NOTA, p=pesos)):
+            p = int(p)
+            if (f, p) not in estilo:
+                estilo[(f, p)] = variante(p)
+            descricao = estilo[(f, p)] if rng.random() < 0.7 else variante(p)
+            if rng.random() < 0.03:
+                descricao = abreviada(descricao)
+            valor = round(float(nrng.lognormal(3, 1)), 2)
+            itens.append({
+                "item": str(k + 1), "codigo": "1" if f in codigo_constante else f"F{f}P{p}",
+                "descricao": descricao, "ncm": produtos[p][3], "cfop": "5102", "unidade": "UN",
+                "quantidade": "1", "valor_unitario": str(valor), "valor_total": str(valor),
+            })
+            reais.append(p)
+        notas.append({"chave": f"{i:044d}", "numero": str(i), "data_emissao": "2023-05-01T10:00:00-03:00",
+                      "emitente_cnpj": f"{f:014d}", "emitente_nome": f"FORNECEDOR {f}",
+                      "itens": json.dumps(itens, ensure_ascii=False)})
+    return pd.DataFrame(notas), np.array(reais)
+
+def qualidade(chaves, reais, valores):
+    """(grupos, grupos por produto real, pureza, top-10 recuperado)"""
+    g = pd.DataFrame({"chave": chaves, "real": reais, "valor": valores})
+    por_grupo = g.groupby(["chave", "real"]).size().reset_index(name="n")
+    majoritario = por_grupo.sort_values("n", ascending=False).drop_duplicates("chave").set_index("chave")
+    top_real = g.groupby("real")["valor"].sum().nlargest(10).index
+    top_grupos = g.groupby("chave")["valor"].sum().nlargest(10).index
+    recuperados = len(set(majoritario["real"].reindex(top_grupos)) & set(top_real))
+    return (g["chave"].nunique(), g.groupby("real")["chave"].nunique().mean(),
+            majoritario["n"].sum() / len(g), recuperados)
+
+def main():
+    parser = argparse.ArgumentParser(description="Velocidade e qualidade do agrupamento de produtos")
+    parser.add_argument("--itens", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    inicio = time.time()
+    df, reais = gerar_notas(args.itens)
+    itens = app.decode_items(df)
+    print(f"✓ {len(itens):,} itens sintéticos, {len(np.unique(reais)):,} produtos reais ({time.time() - inicio:.1f}s)")
+
+    # A primeira rodada normaliza todas as descrições; as seguintes usam o cache
+    tempos = []
+    for _ in range(4):
+        inicio = time.process_time()
+        produtos = app.item_products(df, itens)
+        tempos.append(time.process_time() - inicio)
+    frio, quente = tempos[0], min(tempos[1:])
+    print(f"✓ item_products (CPU): cache frio {frio:.2f}s | cache quente {quente:.2f}s")
+
+    reais = reais[produtos.index.to_numpy()]
+    valores = produtos["valor_total"].to_numpy()
+    casos = [
+        ("descrição exata (upper/strip)", itens.loc[produtos.index, "descricao"].str.upper().str.strip().to_numpy()),
+        ("chave de produto", produtos["chave_produto"].to_numpy()),
+    ]
+    print(f"\n{'agrupamento':<32} {'grupos':>8} {'grupos/produto':>15} {'pureza':>8} {'top-10':>7}")
+    for nome, chaves in casos:
+        grupos, fragmentacao, pureza, recuperados = qualidade(chaves, reais, valores)
+        print(f"{nome:<32} {grupos:>8,} {fragmentacao:>15.2f} {pureza:>8.4f} {recuperados:>5}/10")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Verificação automática do LLMGateway contra o servidor simulado (scripts/fake_gemini_server.py).
+
+Cenários:
+  429,503,ok   duas falhas repetíveis e sucesso na terceira tentativa
+  slowN        resposta mais lenta que o prazo: a chamada desiste no prazo
+  503          falha contínua: as tentativas param antes do prazo
+  400          erro não repetível: propaga na primeira tentativa
+  ok com prazo menor que LLM_TENTATIVA_MIN_MS: desiste sem enviar requisição
+
+Sai com código 1 se algum cenário não tiver o resultado esperado.
+
+Uso:
+  python scripts/check_gateway_gemini.py
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("GEMINI_API_KEY", "teste")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from google import genai  # noqa: E402
+from google.genai import errors, types  # noqa: E402
+
+SERVIDOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_gemini_server.py")
+MODELO = "gemini-2.0-flash-exp"
+FOLGA_S = 1.5
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def executar(plano, prazo_s):
+    """Faz uma chamada pelo gateway com o servidor seguindo `plano`; devolve (resultado, segundos, requisições, contadores)"""
+    porta = porta_livre()
+    servidor = subprocess.Popen([sys.executable, SERVIDOR, "--porta", str(porta), "--plano", plano],
+                                stdout=subprocess.PIPE, text=True)
+    try:
+        servidor.stdout.readline()  # linha de início: servidor pronto
+        cliente = genai.Client(api_key="teste", http_options=types.HttpOptions(base_url=f"http://127.0.0.1:{porta}"))
+        gateway = app.LLMGateway(cliente, rpm=600, tpm=10**6, max_concorrencia=1, max_tentativas=4, prazo_s=prazo_s)
+
+        inicio = time.monotonic()
+        try:
+            resultado = gateway.generate(MODELO, "teste", types.GenerateContentConfig(max_output_tokens=16))
+        except Exception as e:
+            resultado = e
+        duracao = time.monotonic() - inicio
+    finally:
+        servidor.terminate()
+        saida, _ = servidor.communicate()
+    requisicoes = sum(linha.startswith("#") for linha in saida.splitlines())
+    return resultado, duracao, requisicoes, gateway.contadores
+
+def main():
+    falhas = []
+
+    def verificar(nome, condicao, detalhe):
+        print(f"{'✓' if condicao else '✗'} {nome}: {detalhe}")
+        if not condicao:
+            falhas.append(nome)
+
+    resultado, duracao, requisicoes, contadores = executar("429,503,ok", prazo_s=20)
+    verificar("429,503,ok", getattr(resultado, "text", None) and requisicoes == 3
+              and contadores["repeticoes"] == 2 and contadores["erros_429"] == 1 and contadores["sucessos"] == 1,
+              f"{requisicoes} requisições, {contadores['repeticoes']} repetições em {duracao:.1f}s")
+
+    prazo_s = 3
+    resultado, duracao, requisicoes, contadores = executar("slow10", prazo_s=prazo_s)
+    verificar("slow10", isinstance(resultado, app.LLMIndisponivelError) and duracao < prazo_s + FOLGA_S
+              and contadores["prazos_esgotados"] == 1,
+              f"{type(resultado).__name__} em {duracao:.1f}s (prazo {prazo_s}s)")
+
+    resultado, duracao, requisicoes, contadores = executar("503", prazo_s=prazo_s)
+    verificar("503 contínuo", isinstance(resultado, app.LLMIndisponivelError) and duracao < prazo_s + FOLGA_S
+              and 1 <= requisicoes <= 4 and contadores["falhas"] == 1,
+              f"{type(resultado).__name__} após {requisicoes} requisições em {duracao:.1f}s")
+
+    resultado, duracao, requisicoes, contadores = executar("400", prazo_s=prazo_s)
+    verificar("400", isinstance(resultado, errors.ClientError) and requisicoes == 1 and contadores["repeticoes"] == 0,
+              f"{type(resultado).__name__} após {requisicoes} requisição(ões)")
+
+    resultado, duracao, requisicoes, contadores = executar("ok", prazo_s=app.LLM_TENTATIVA_MIN_MS / 2000)
+    verificar("prazo curto", isinstance(resultado, app.LLMIndisponivelError) and requisicoes == 0
+              and contadores["prazos_esgotados"] == 1,
+              f"{type(resultado).__name__} após {requisicoes} requisição(ões)")
+
+    if falhas:
+        print(f"\n✗ {len(falhas)} cenário(s) falharam: {', '.join(falhas)}")
+        sys.exit(1)
+    print("\n✓ Retry e prazo do gateway conferem")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Servidor local que imita a API do Gemini para testar limites, retries e prazo da análise.
+
+Cada requisição POST consome a próxima ação do plano (a última se repete):
+  ok       resposta normal
+  429      cota excedida (com Retry-After)
+  503      serviço indisponível (ou qualquer outro status HTTP)
+  slowN    espera N segundos e responde normalmente
+
+Uso:
+  python scripts/fake_gemini_server.py --porta 8089 --plano 429,429,ok
+  GEMINI_API_KEY=teste GEMINI_BASE_URL=http://127.0.0.1:8089 python app.py
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATUS_ERRO = {429: "RESOURCE_EXHAUSTED", 503: "UNAVAILABLE"}
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    plano = ["ok"]
+    requisicoes = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def proxima_acao(self):
+        with self.lock:
+            acao = self.plano[min(FakeGeminiHandler.requisicoes, len(self.plano) - 1)]
+            FakeGeminiHandler.requisicoes += 1
+            return FakeGeminiHandler.requisicoes, acao
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        numero, acao = self.proxima_acao()
+        print(f"#{numero} {self.path} -> {acao}", flush=True)
+
+        if acao.startswith("slow"):
+            time.sleep(float(acao[4:]))
+            acao = "ok"
+
+        if acao == "ok":
+            codigo = 200
+            corpo = {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": "Análise simulada pelo servidor local."}]}}],
+                "usageMetadata": {"totalTokenCount": 42},
+            }
+        else:
+            codigo = int(acao)
+            corpo = {"error": {"code": codigo, "message": "erro simulado", "status": STATUS_ERRO.get(codigo, "UNKNOWN")}}
+
+        dados = json.dumps(corpo, ensure_ascii=False).encode("utf-8")
+        self.send_response(codigo)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(dados)))
+        if codigo == 429:
+            self.send_header("retry-after", "1")
+        self.end_headers()
+        self.wfile.write(dados)
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local que simula a API do Gemini")
+    parser.add_argument("--porta", type=int, default=8089)
+    parser.add_argument("--plano", default="429,429,ok",
+                        help="ações por requisição, separadas por vírgula (ok, 429, 503, slowN)")
+    args = parser.parse_args()
+
+    FakeGeminiHandler.plano = [acao.strip() for acao in args.plano.split(",") if acao.strip()]
+    print(f"✓ Gemini simulado em http://127.0.0.1:{args.porta} — plano: {', '.join(FakeGeminiHandler.plano)}", flush=True)
+    ThreadingHTTPServer(("127.0.0.1", args.porta), FakeGeminiHandler).serve_forever()
+
+if __name__ == "__main__":
+    main()